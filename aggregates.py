@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+'''
+Word-independent counts, served from memory-mapped files.
+
+The bar chart shows TextCount/WordCount by facet value, and the date
+distribution of each value. Those counts don't depend on a search word and
+only change when the Bookworm is rebuilt, so they can be fetched once by a
+build step and saved as NumPy arrays:
+
+    python aggregates.py build [--groups language class ...]
+    python aggregates.py status
+
+Each build goes in its own directory, and manifest.json, written last,
+points to the current one. Readers open the arrays with mmap, so every
+worker shares the same pages through the OS page cache, and a rebuild is
+picked up without a restart.
+
+    BW_AGGREGATES  aggregate store directory (default: data/aggregates)
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import logging
+import numpy as np
+import pandas as pd
+import matrix
+import facets
+from bookworm import QuerySpec, run, submit
+
+counttypes = ['WordCount', 'TextCount']
+
+class AggregateStore(object):
+
+    def __init__(self, path, max_facet_id=60, min_year=1801, max_year=2015):
+        self.path = path
+        self.max_facet_id = max_facet_id
+        self.min_year = min_year
+        self.max_year = max_year
+        self._lock = threading.Lock()
+        self._manifest = None
+        self._manifest_mtime = None
+        self._groups = {}
+
+    def manifest(self):
+        ''' The current manifest, or None if nothing has been built. '''
+        fname = os.path.join(self.path, 'manifest.json')
+        try:
+            mtime = os.stat(fname).st_mtime
+        except OSError:
+            return None
+        with self._lock:
+            if mtime != self._manifest_mtime:
+                with open(fname, 'r') as f:
+                    self._manifest = json.load(f)
+                self._manifest_mtime = mtime
+                self._groups = {}
+            return self._manifest
+
+    def has(self, group):
+        manifest = self.manifest()
+        return manifest is not None and group in manifest['groups']
+
+    def _open(self, group):
+        # Arrays for a group, mapped on first use and shared until the next build
+        manifest = self.manifest()
+        with self._lock:
+            if group not in self._groups:
+                dirname = os.path.join(self.path, manifest['build'], group)
+                with open(os.path.join(dirname, 'labels.json'), 'r') as f:
+                    labels = np.array(json.load(f), dtype=object)
+                self._groups[group] = {
+                    'labels': labels,
+                    'known': np.load(os.path.join(dirname, 'known.npy'), mmap_mode='r'),
+                    'totals': np.load(os.path.join(dirname, 'totals.npy'), mmap_mode='r'),
+                    'years': np.load(os.path.join(dirname, 'years.npy'), mmap_mode='r'),
+                }
+            return self._groups[group]
+
+    def open_all(self):
+        ''' Map the arrays of every group now, rather than on first use. '''
+        manifest = self.manifest()
+        for group in (manifest['groups'] if manifest else []):
+            self._open(group)
+
+    def frame(self, group, drop_unknowns=False):
+        '''
+        Counts by value of a group, like the frame of a bar chart query:
+        a column for the group, then WordCount and TextCount.
+        '''
+        arrays = self._open(group)
+        df = pd.DataFrame(np.asarray(arrays['totals']), columns=counttypes)
+        df.insert(0, group, arrays['labels'])
+        if drop_unknowns:
+            df = df[np.asarray(arrays['known'])]
+        return df
+
+    def date_matrix(self, group):
+        ''' TextCount by value and year, as a Matrix over the mapped array. '''
+        arrays = self._open(group)
+        manifest = self.manifest()
+        return matrix.Matrix(arrays['labels'],
+                             np.arange(manifest['min_year'], manifest['max_year'] + 1),
+                             arrays['years'])
+
+    def _fetch(self, group):
+        id_limit = { group + '__id': {"$lt": self.max_facet_id} }
+        spec = QuerySpec(groups=['*' + group], search_limits=id_limit,
+                         counttype=counttypes, kind='aggregates')
+        results = run(spec)
+        totals = results.frame(index=False)
+        # bwypy keeps the index of the rows it doesn't drop
+        known = totals.index.isin(results.frame(index=False, drop_unknowns=True).index)
+
+        spec = QuerySpec(groups=[group, 'date_year'], counttype=['TextCount'], kind='aggregates',
+                         search_limits=dict(id_limit, date_year={"$gte": self.min_year,
+                                                                 "$lte": self.max_year}))
+        dates = run(spec).frame(index=False)
+        dates.date_year = pd.to_numeric(dates.date_year)
+        by_year = matrix.Matrix.from_frame(dates, group, 'date_year', 'TextCount',
+                                           self.min_year, self.max_year)
+        # Rows in the same order as the totals, zero for values with no dates
+        years = np.zeros((len(totals), self.max_year - self.min_year + 1))
+        for i, label in enumerate(totals[group].values):
+            if label in by_year:
+                years[i] = by_year.row(label)[:years.shape[1]]
+        return totals, known, years
+
+    def build(self, groups=None):
+        ''' Fetch the counts for some groups (default: every character field) and save them. '''
+        groups = groups or facets.store.fields('character')
+        futures = {group: submit(self._fetch, group) for group in groups}
+        build = time.strftime('%Y%m%d-%H%M%S')
+        dirname = os.path.join(self.path, build)
+        built = {}
+        for group, future in futures.items():
+            try:
+                totals, known, years = future.result()
+            except Exception:
+                logging.exception("Could not build aggregates for %s", group)
+                continue
+            os.makedirs(os.path.join(dirname, group), exist_ok=True)
+            with open(os.path.join(dirname, group, 'labels.json'), 'w') as f:
+                json.dump([str(label) for label in totals[group].values], f)
+            np.save(os.path.join(dirname, group, 'known.npy'), np.asarray(known, dtype=bool))
+            np.save(os.path.join(dirname, group, 'totals.npy'), totals[counttypes].values.astype(np.int64))
+            np.save(os.path.join(dirname, group, 'years.npy'), years)
+            built[group] = len(totals)
+        if not built:
+            raise Exception("No aggregates could be built")
+
+        previous = self.manifest()
+        manifest = {'created': time.time(), 'build': build, 'groups': built,
+                    'max_facet_id': self.max_facet_id,
+                    'min_year': self.min_year, 'max_year': self.max_year}
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp, os.path.join(self.path, 'manifest.json'))
+        # Workers still mapping the old build keep their open files
+        if previous is not None and previous['build'] != build:
+            shutil.rmtree(os.path.join(self.path, previous['build']), ignore_errors=True)
+        return manifest
+
+store = AggregateStore(os.environ.get('BW_AGGREGATES', os.path.join('data', 'aggregates')))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or inspect the aggregate store.")
+    parser.add_argument('command', choices=['build', 'status'])
+    parser.add_argument('--groups', nargs='*', help="Groups to build (default: all character fields)")
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        manifest = store.build(args.groups)
+        print("Saved counts for %d groups to %s" % (len(manifest['groups']),
+                                                    os.path.join(store.path, manifest['build'])))
+    else:
+        manifest = store.manifest()
+        if manifest is None:
+            print("No aggregates at %s" % store.path)
+            return 1
+        print("%s: %d groups, %.1f days old" % (store.path, len(manifest['groups']),
+                                                (time.time() - manifest['created']) / 86400.))
+        for group, n in sorted(manifest['groups'].items()):
+            print("  %s (%d values)" % (group, n))
+        return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,13 +2,11 @@
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output
-import plotly
-import plotly.graph_objs as go
-import pandas as pd
+import flask
 from common import app
-from tools import load_page
-import json
+from tools import LazyPage
+import warmer
+import preload
 
 server = app.server
 
@@ -17,7 +15,31 @@ page_info = [
     {"name":"Map Search", "slug":"map", "path":'map' },
     {"name":"Heat Map", "slug":"heatmap", "path":'heatmap' }
 ]
-pages = { page['slug']: load_page(page['path']+'.py') for page in page_info }
+# Pages are loaded on first use rather than at import, so a worker boots
+# without touching the Bookworm endpoint.
+pages = { page['slug']: LazyPage(page['path']+'.py') for page in page_info }
+
+def load_pages():
+    for page in pages.values():
+        page.load()
+
+if preload.active:
+    # Under gunicorn -c gunicorn.conf.py, build everything once in the
+    # master for the workers to share. The warmer starts in each worker.
+    preload.prepare(load_pages)
+else:
+    # Count calls to cached data functions, and warm the cache in the
+    # background with the defaults of loaded pages and popular calls (see
+    # warmer.py)
+    warmer.start()
+
+@server.before_request
+def load_pages_for_renderer():
+    # The renderer reads the whole callback graph once, from
+    # _dash-dependencies, so every page's callbacks must be registered
+    # before it (or a callback) is served.
+    if flask.request.path.endswith(('_dash-dependencies', '_dash-update-component')):
+        load_pages()
 
 header_bar = html.Nav(className='navbar navbar-dark bg-dark navbar-expand-lg', children=[
             dcc.Link("Bookworm Playground", href=app.url_base_pathname, className="navbar-brand", style=dict(color='#fff')),
@@ -68,9 +90,9 @@ def display_page(pathname):
         if not (pathparts[0] == app.url_base_pathname.strip('/')):
             raise Exception('Unknown page')
         if (len(pathparts) == 1):
-            return pages['map']
+            return pages['map'].layout
         if pathparts[1] in pages:
-            return pages[pathparts[1]]
+            return pages[pathparts[1]].layout
         else:
             raise Exception('Unknown page')
     except:
@@ -1,46 +1,133 @@
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output
-import plotly
+from dash.dependencies import State, Input, Output
 import plotly.graph_objs as go
-from plotly import figure_factory as FF
 import pandas as pd
 import functools
+import logging
+from cache import cached
 from common import app
 from common import graphconfig
-from tools import get_facet_group_options
-import bwypy
+from tools import get_facet_group_options, pretty_facet
+from bookworm import QuerySpec, run, submit
+import matrix
+import metrics
+import figures
+import aggregates
+import warmer
 
 app.config.supress_callback_exceptions=True
 
-bwypy.set_options(database='Bookworm2016', endpoint='https://bookworm.htrc.illinois.edu/cgi-bin/dbbindings.py')
-bw = bwypy.BWQuery(verify_fields=False)
+# Base queries. Each call derives its own spec from these with replace()
+bw = QuerySpec(counttype=['WordCount', 'TextCount'], kind='bar')
+bw_date = QuerySpec(groups=['date_year'], counttype=['TextCount'], kind='bar')
 
-facet_opts = get_facet_group_options(bw)
+facet_opts = get_facet_group_options()
+
+# Only the most common values of a group are fetched and shown
+max_facet_id = 60
+default_group = 'language'
 
 # This will cache identical calls
-@functools.lru_cache(maxsize=32)
-def get_results(group):
-    bw.counttype = ['WordCount', 'TextCount']
-    bw.groups = ['*'+group]
-    bw.search_limits = { group + '__id' : {"$lt": 60 } }
-    return bw.run()
+@cached()
+def get_counts(group):
+    '''
+    Counts by value of a group, as a frame, and which of its rows are
+    known values.
+    '''
+    spec = bw.replace(groups=['*'+group], search_limits={ group + '__id' : {"$lt": max_facet_id } })
+    results = run(spec)
+    df = results.frame(index=False)
+    # bwypy keeps the index of the rows it doesn't drop
+    known = df.index.isin(results.frame(index=False, drop_unknowns=True).index)
+    return df, known
 
-bw_date = bwypy.BWQuery(verify_fields=False)
+def get_frame(group, drop_unknowns):
+    ''' Counts by value of a group, from the aggregate store when it has the group. '''
+    if aggregates.store.has(group):
+        return aggregates.store.frame(group, drop_unknowns)
+    df, known = get_counts(group)
+    return df[known] if drop_unknowns else df
+
+@cached()
+def get_date_distributions(group):
+    '''
+    Date distributions of every value the bar chart can show, in one query.
+    '''
+    spec = bw_date.replace(groups=[group, 'date_year'],
+                           search_limits={ group + '__id': {"$lt": max_facet_id},
+                                           'date_year': {"$gt": 1800, "$lt": 2016} })
+    df = run(spec).frame(index=False)
+    df.date_year = pd.to_numeric(df.date_year)
+    return df
+
+# The default group is always served from a warm cache
+warmer.keep_warm(get_counts, default_group)
+warmer.keep_warm(get_date_distributions, default_group)
+
+def get_date_matrix(group):
+    '''
+    Smoothed date distributions for a group, as a value x year matrix kept in
+    memory, so hovering over a bar doesn't need a query.
+    '''
+    manifest = aggregates.store.manifest()
+    if manifest is not None and group in manifest['groups']:
+        return _date_matrix(group, manifest['build'], None)
+    version = get_date_distributions.version(group)
+    if version is None:
+        # Nothing is cached to tell when the matrix would be out of date
+        return _date_matrix.__wrapped__(group, None, version)
+    return _date_matrix(group, None, version)
 
 @functools.lru_cache(maxsize=32)
+def _date_matrix(group, build, version):
+    # build is the aggregate store build the matrix comes from, or None if
+    # it was fetched, in which case version is the cached distributions'
+    # version (see cache.cached). Either way a newer one replaces it.
+    if build is not None:
+        m = aggregates.store.date_matrix(group)
+        return matrix.Matrix(m.labels, m.columns, matrix.smooth_rows(m.values, 10))
+    df = get_date_distributions(group)
+    return matrix.Matrix.from_frame(df, group, 'date_year', 'TextCount', 1801, 2015, smoothing=10)
+
+def prefetch_date_matrix(group):
+    ''' Start loading a group's date distributions in the background. '''
+    def log_failure(future):
+        if future.exception() is not None:
+            logging.error("Date distribution prefetch for %s failed: %s", group, future.exception())
+    submit(get_date_matrix, group).add_done_callback(log_failure)
+
+@cached()
 def get_date_distribution(group, facet):
-    bw_date.groups = ['date_year']
-    bw_date.counttype = ['TextCount']
-    bw_date.search_limits = { group: facet }
-    results = bw_date.run()
+    spec = bw_date.replace(search_limits={ group: facet })
+    results = run(spec)
     df = results.frame(index=False)
     df.date_year = pd.to_numeric(df.date_year)
+    return smooth_date_distribution(df)
+
+@metrics.timed('transform')
+def smooth_date_distribution(df):
+    ''' The years 1801-2015 of a date distribution, in order, with a 10-year moving average. '''
     df2 = df.query('(date_year > 1800) and (date_year < 2016)').sort_values('date_year', ascending=True)
     df2['smoothed'] = df2.TextCount.rolling(10, 0).mean()
     return df2
 
+table_page_size = 15
+table_headers = {'TextCount': '# of Texts', 'WordCount': '# of Words'}
+
+@metrics.timed('transform')
+def table_page(df, sort_by, ascending, page, page_size=table_page_size):
+    '''
+    Sort a frame and cut out one page of it. Returns the rows, the page
+    number (clamped to the pages that exist) and the number of pages.
+    '''
+    n_pages = max(1, -(-len(df) // page_size))
+    page = min(max(1, page), n_pages)
+    df = df.sort_values(sort_by, ascending=ascending)
+    start = (page - 1) * page_size
+    return df.iloc[start:start + page_size], page, n_pages
+
 header = '''
 # Bookworm Bar Chart
 Select a field and see the raw counts in the Bookworm database
@@ -49,7 +136,7 @@ Select a field and see the raw counts in the Bookworm database
 controls = html.Div([
         dcc.Markdown(header),
         html.Label("Facet Group"),
-        dcc.Dropdown(id='group-dropdown', options=facet_opts, value='language'),
+        dcc.Dropdown(id='group-dropdown', options=facet_opts, value=default_group),
         html.Label("Number of results to show"),
         dcc.Slider(id='trim-slider', min=10, max=60, value=20, step=5,
                    marks={str(n): str(n) for n in range(10, 61, 10)}),
@@ -78,7 +165,24 @@ app.layout = html.Div([
             ],
             className='row'),
     html.Div([
-                html.Div([html.H2("Data"), dcc.Graph(id='bar-data-table')], id='data-table', className='col-md-5'),
+                html.Div([html.H2("Data"),
+                          html.Div([
+                              html.Div([html.Label("Sort by"),
+                                        dcc.Dropdown(id='table-sort', clearable=False, value='TextCount',
+                                                     options=[{'label': u'Value', 'value': 'facet'},
+                                                              {'label': u'# of Texts', 'value': 'TextCount'},
+                                                              {'label': u'# of Words', 'value': 'WordCount'}])],
+                                       className='col-md-5'),
+                              html.Div(dcc.RadioItems(id='table-order', value='desc',
+                                                      options=[{'label': u'Descending', 'value': 'desc'},
+                                                               {'label': u'Ascending', 'value': 'asc'}]),
+                                       className='col-md-4'),
+                              html.Div([html.Label("Page"),
+                                        dcc.Input(id='table-page', type='number', min=1, value=1,
+                                                  style={'width': '5em'})],
+                                       className='col-md-3')
+                          ], className='row'),
+                          html.Div(id='bar-data-table')], id='data-table', className='col-md-5'),
                 html.Div([dcc.Graph(id='date-distribution')], id='graph-wrapper', className='col-md-7')
              ],
             className='row')
@@ -91,11 +195,13 @@ app.layout = html.Div([
      Input('drop-radio', 'value'), Input('counttype-dropdown', 'value')]
 )
 def update_figure(group, trim_at, drop_radio, counttype):
-    bw.groups = [group]
-    results = get_results(group)
+    prefetch_date_matrix(group)
+    df = get_frame(group, drop_radio=='drop')
+    return bar_figure(df, group, trim_at, counttype)
 
-    df = results.frame(index=False, drop_unknowns=(drop_radio=='drop'))
-    df = df.copy()
+@metrics.timed('figure')
+def bar_figure(df, group, trim_at, counttype):
+    ''' The bar chart of the first `trim_at` values of a group. '''
     df_trimmed = df.head(trim_at)
         
     data = [
@@ -105,31 +211,47 @@ def update_figure(group, trim_at, drop_radio, counttype):
         )
     ]
     
-    return {
+    return figures.compact({
             'data': data,
             'layout': {
                 'yTitle': counttype,
                 'title': group.replace('_', ' ').title()
             }
-        }
+        })
 
 @app.callback(
-    Output('bar-data-table', 'figure'),
-    [Input('group-dropdown', 'value'), Input('drop-radio', 'value')]
+    Output('table-page', 'value'),
+    [Input('group-dropdown', 'value'), Input('drop-radio', 'value'),
+     Input('table-sort', 'value'), Input('table-order', 'value')]
 )
-def update_table(group, drop_radio):
-    results = get_results(group)
-    df = results.frame(index=False, drop_unknowns=(drop_radio=='drop'))
-    df = df.copy()
-    return FF.create_table(df)
-    #return html.Table(
-        # Header
-        #[html.Tr([html.Th(col) for col in df.columns])] +
-        # Body
-        #[html.Tr([
-        #            html.Td(df.iloc[i][col]) for col in df.columns
-        #        ]) for i in range(min(len(df), 100))]
-    #)
+def reset_table_page(group, drop_radio, sort_by, order):
+    return 1
+
+# Changing the data or its order goes back to the first page, which in turn
+# redraws the table, so the table only needs to listen to the page.
+@app.callback(
+    Output('bar-data-table', 'children'),
+    [Input('table-page', 'value')],
+    state=[State('group-dropdown', 'value'), State('drop-radio', 'value'),
+           State('table-sort', 'value'), State('table-order', 'value')]
+)
+def update_table(page, group, drop_radio, sort_by, order):
+    df = get_frame(group, drop_radio=='drop')
+    try:
+        page = int(page)
+    except (TypeError, ValueError):
+        page = 1
+    rows, page, n_pages = table_page(df, group if sort_by == 'facet' else sort_by,
+                                     order == 'asc', page)
+    return html.Div([
+        html.Table(
+            # Header
+            [html.Tr([html.Th(table_headers.get(col, pretty_facet(col))) for col in rows.columns])] +
+            # Body, only the visible page
+            [html.Tr([html.Td(value) for value in row]) for row in rows.values.tolist()],
+            className='table table-sm'),
+        html.Small("Page %d of %d (%d rows)" % (page, n_pages, len(df)))
+    ])
 
 @app.callback(
     Output('date-distribution', 'figure'),
@@ -137,22 +259,31 @@ def update_table(group, drop_radio):
 def print_hover_data(clickData, group):
     if clickData:
         facet_value = clickData['points'][0]['x']
-        df = get_date_distribution(group, facet_value)
-        df = df.copy()
+        try:
+            m = get_date_matrix(group)
+        except Exception:
+            # Fall back on fetching just this value's distribution
+            logging.warning("Date distributions for %s unavailable", group, exc_info=True)
+            m = None
+        if m is not None and facet_value in m:
+            years, smoothed = m.columns, m.row(facet_value)
+        else:
+            df = get_date_distribution(group, facet_value)
+            years, smoothed = df['date_year'], df['smoothed']
         data = [
             go.Scatter(
-                x=df['date_year'],
-                y=df['smoothed']
+                x=years,
+                y=smoothed
             )
         ]
-        return {
+        return figures.compact({
             'data': data,
             'layout': {
                 'height': 300,
-                'yaxis': {'range': [0, int(df.smoothed.max())+100]},
+                'yaxis': {'range': [0, int(smoothed.max())+100]},
                 'title': 'Date Distribution for ' + facet_value.replace('_', ' ').title()
             }
-        }
+        }, decimals=1)
     else:
         data = [
             go.Scatter(
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmarks for the data transforms behind the pages, at increasing scale.
+
+Each benchmark feeds one transform synthetic results shaped like Bookworm's:
+heatmaps and bar charts of 10 to 5,000 facet values over 365 years, date
+distributions, and maps of every country (alone and with a comparison term)
+and every US state. For each it records the time per call, the best of
+several rounds after a warm-up, and the peak memory one call allocates,
+traced with tracemalloc in a separate call since tracing slows it down.
+
+    python bench.py run [--scales 10 100 1000 5000] [--only heatmap map] [--save]
+    python bench.py run --compare benchmarks/abc1234.json
+    python bench.py compare benchmarks/abc1234.json benchmarks/def5678.json
+
+--save writes the results to benchmarks/<commit>.json, so that a baseline
+can be kept for any commit and compared against later. A comparison lists
+the change in time and memory of every benchmark, and exits with 1 when
+any is more than --threshold (default 1.25) times its baseline.
+
+The pages are imported against a synthetic stand-in served from this
+process (see standin.py); the benchmarks themselves never query it.
+'''
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+here = os.path.dirname(os.path.abspath(__file__))
+default_scales = [10, 100, 1000, 5000]
+min_year, max_year = 1651, 2015
+
+# name -> (setup, scaled); setup(scale) returns the call to time
+benchmarks = {}
+
+def benchmark(name, scaled=True):
+    ''' Register a setup function for a benchmark. '''
+    def decorator(setup):
+        benchmarks[name] = (setup, scaled)
+        return setup
+    return decorator
+
+def _labels(n, field='class'):
+    return np.array(["%s %05d" % (field.replace('_', ' ').title(), i) for i in range(n)], dtype=object)
+
+def facet_years(n, field='class', density=0.8, seed=0):
+    ''' Long results of a facet x year query: n values over 365 years, with some cells missing. '''
+    rng = np.random.RandomState(seed)
+    years = np.arange(min_year, max_year + 1)
+    labels = np.repeat(_labels(n, field), len(years))
+    date_year = np.tile(years, n)
+    keep = rng.rand(len(labels)) < density
+    return pd.DataFrame({field: labels[keep], 'date_year': date_year[keep],
+                         'WordsPerMillion': rng.lognormal(0, 1.5, keep.sum())},
+                        columns=[field, 'date_year', 'WordsPerMillion'])
+
+def facet_counts(n, field='language', seed=0):
+    ''' Results of a bar chart query: counts for n values, most common first. '''
+    rng = np.random.RandomState(seed)
+    texts = np.sort(rng.lognormal(8, 2, n).astype(np.int64))[::-1]
+    return pd.DataFrame({field: _labels(n, field), 'WordCount': texts * rng.randint(5000, 50000, n),
+                         'TextCount': texts}, columns=[field, 'WordCount', 'TextCount'])
+
+def date_distribution(seed=0):
+    ''' Results of a date distribution query for one value, unordered, with years outside 1801-2015. '''
+    rng = np.random.RandomState(seed)
+    years = rng.permutation(np.arange(min_year, max_year + 1))
+    return pd.DataFrame({'date_year': years, 'TextCount': rng.poisson(200, len(years))})
+
+def places(field, seed=0):
+    ''' Results of a map query: every place in a code table, as Bookworm names them. '''
+    import geocodes
+    rng = np.random.RandomState(seed)
+    names = pd.read_csv(geocodes.tables[field])[field].values
+    return pd.DataFrame({field: names, 'WordsPerMillion': rng.lognormal(1, 2, len(names))},
+                        columns=[field, 'WordsPerMillion'])
+
+def _pages():
+    # The pages register callbacks on the common app, which needs a Bookworm
+    # endpoint for facet metadata: use a local stand-in
+    if 'heatmap' not in sys.modules:
+        import standin
+        standin.use_locally()
+    import heatmap
+    import bar_chart
+    import map as map_page
+    return heatmap, bar_chart, map_page
+
+@benchmark('heatmap.format_heatmap_data')
+def bench_format_heatmap_data(n):
+    heatmap = _pages()[0]
+    df = facet_years(n)
+    return lambda: heatmap.format_heatmap_data(df, 'computer', True, 5, min_year, max_year)
+
+@benchmark('heatmap.view')
+def bench_heatmap_view(n):
+    # What heatmap_search does with a cached matrix: select the slider's
+    # years, bin them to the cell budget, plot and compact
+    import matrix
+    import figures
+    heatmap = _pages()[0]
+    df = facet_years(n)
+
+    def view():
+        m = matrix.Matrix.from_frame(df, 'class', 'date_year', 'WordsPerMillion',
+                                     min_year, max_year, log=True, smoothing=5)
+        block = m.select(None, 1900, 2000)
+        width = heatmap.level_of_detail(len(block.labels), 1900, 2000)
+        plotdata, layout = heatmap.heatmap_figure(block, 'computer', 'class', width)
+        return figures.compact(dict(data=plotdata, layout=layout))
+    return view
+
+@benchmark('bar.bar_figure')
+def bench_bar_figure(n):
+    bar_chart = _pages()[1]
+    df = facet_counts(n)
+    return lambda: bar_chart.bar_figure(df, 'language', 60, 'TextCount')
+
+@benchmark('bar.date_matrix')
+def bench_date_matrix(n):
+    # Every value's smoothed date distribution, as hovering over bars uses it
+    import matrix
+    df = facet_years(n, field='language').rename(columns={'WordsPerMillion': 'TextCount'})
+    return lambda: matrix.Matrix.from_frame(df, 'language', 'date_year', 'TextCount',
+                                            1801, 2015, smoothing=10)
+
+@benchmark('bar.smooth_date_distribution', scaled=False)
+def bench_smooth_date_distribution(_):
+    bar_chart = _pages()[1]
+    df = date_distribution()
+    return lambda: bar_chart.smooth_date_distribution(df.copy())
+
+def _map_benchmark(scope, type, compare):
+    def setup(_):
+        map_page = _pages()[2]
+        import geocodes
+        field = map_page.map_scopes[scope]['field']
+        data = geocodes.with_codes(places(field), field)
+        data2 = geocodes.with_codes(places(field, seed=1), field) if compare else None
+        return lambda: map_page.map_figure(data, data2, 'color', 'colour' if compare else None, type, scope)
+    return setup
+
+for _scope in ['country', 'state']:
+    for _type in ['scattergeo', 'choropleth']:
+        for _compare in [False, True]:
+            benchmark('map.map_figure[%s,%s%s]' % (_scope, _type, ',compare' if _compare else ''),
+                      scaled=False)(_map_benchmark(_scope, _type, _compare))
+
+@benchmark('map.with_codes', scaled=False)
+def bench_with_codes(_):
+    import geocodes
+    df = places('publication_country')
+    geocodes.index('publication_country')
+    return lambda: geocodes.with_codes(df, 'publication_country')
+
+@benchmark('errorfig', scaled=False)
+def bench_errorfig(_):
+    from tools import errorfig
+    return errorfig
+
+def measure(func, min_time=0.5, max_rounds=200):
+    '''
+    Time a call: the best and median of as many rounds as fit in `min_time`
+    (at least 3), after one warm-up call. Then its peak traced memory.
+    '''
+    func()
+    times = []
+    started = time.time()
+    while len(times) < 3 or (time.time() - started < min_time and len(times) < max_rounds):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(times), 'median': float(np.median(times)), 'rounds': len(times),
+            'peak_bytes': peak}
+
+def commit():
+    ''' The current commit, marked -dirty if the tree has changes, or None outside git. '''
+    try:
+        head = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=here,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                        cwd=here, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return head + ('-dirty' if dirty else '')
+
+def run(scales=default_scales, only=None, min_time=0.5):
+    ''' Run the benchmarks whose names start with any of `only` (all by default). '''
+    results = {}
+    for name, (setup, scaled) in sorted(benchmarks.items()):
+        if only and not any(name.startswith(prefix) for prefix in only):
+            continue
+        for scale in (scales if scaled else [None]):
+            key = name if scale is None else '%s[%d]' % (name, scale)
+            results[key] = measure(setup(scale), min_time)
+            print("%-52s %10.3f ms %10.2f MB" % (key, results[key]['seconds'] * 1000,
+                                                 results[key]['peak_bytes'] / 1e6))
+            sys.stdout.flush()
+    return {'commit': commit(), 'created': time.time(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'pandas': pd.__version__, 'machine': platform.node(),
+            'results': results}
+
+def compare(baseline, current, threshold=1.25):
+    ''' Print the change from a baseline run. Returns the benchmarks that regressed. '''
+    print("%s -> %s" % (baseline.get('commit'), current.get('commit')))
+    print("%-52s %10s %10s %7s %10s %7s" % ('benchmark', 'base ms', 'ms', 'time', 'MB', 'memory'))
+    regressed = []
+    for key, new in sorted(current['results'].items()):
+        old = baseline['results'].get(key)
+        if old is None:
+            print("%-52s %10s %10.3f %7s %10.2f %7s" % (key, '-', new['seconds'] * 1000, 'new',
+                                                       new['peak_bytes'] / 1e6, ''))
+            continue
+        time_ratio = new['seconds'] / old['seconds'] if old['seconds'] else float('inf')
+        memory_ratio = new['peak_bytes'] / float(old['peak_bytes']) if old['peak_bytes'] else 1.
+        flag = ''
+        if time_ratio > threshold or memory_ratio > threshold:
+            regressed.append(key)
+            flag = '  <- regression'
+        print("%-52s %10.3f %10.3f %6.2fx %10.2f %6.2fx%s" % (
+            key, old['seconds'] * 1000, new['seconds'] * 1000, time_ratio,
+            new['peak_bytes'] / 1e6, memory_ratio, flag))
+    return regressed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the data transforms.")
+    sub = parser.add_subparsers(dest='command')
+    run_parser = sub.add_parser('run', help="Run the benchmarks")
+    run_parser.add_argument('--scales', type=int, nargs='*', default=default_scales,
+                            help="Facet values per scaled benchmark")
+    run_parser.add_argument('--only', nargs='*', help="Only benchmarks starting with these names")
+    run_parser.add_argument('--min-time', type=float, default=0.5, help="Seconds of rounds per benchmark")
+    run_parser.add_argument('--save', nargs='?', const='', default=None,
+                            help="Save the results (default: benchmarks/<commit>.json)")
+    run_parser.add_argument('--compare', help="Baseline to compare against")
+    run_parser.add_argument('--threshold', type=float, default=1.25)
+    compare_parser = sub.add_parser('compare', help="Compare two saved runs")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=1.25)
+    args = parser.parse_args(argv)
+
+    if args.command == 'compare':
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        with open(args.current, 'r') as f:
+            current = json.load(f)
+        return 1 if compare(baseline, current, args.threshold) else 0
+    if args.command != 'run':
+        parser.print_help()
+        return 2
+
+    current = run(args.scales, args.only, args.min_time)
+    if args.save is not None:
+        fname = args.save or os.path.join(here, 'benchmarks', '%s.json' % (current['commit'] or 'unknown'))
+        dirname = os.path.dirname(fname)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(fname, 'w') as f:
+            json.dump(current, f, indent=1, sort_keys=True)
+        print("Saved to %s" % fname)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        print()
+        return 1 if compare(baseline, current, args.threshold) else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+'''
+Immutable Bookworm query specifications, and the executor that runs them.
+
+Pages used to share module-level bwypy.BWQuery objects and mutate their
+search_limits/groups before each run(), which let concurrent requests
+overwrite each other. A QuerySpec can't be changed once built: callers derive
+a new one with replace() and hand it to run(), so nothing is shared between
+requests.
+
+Identical queries that are in flight at the same time are coalesced: the
+first caller queries the endpoint and the others wait for its result. A
+query contained in one answered recently is cut out of that response
+instead of being sent (see planner.py), unless it refreshes a cached value.
+'''
+import os
+import copy
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import bwypy
+import pandas as pd
+from transport import Transport
+from planner import planner, canonical_key
+import cache
+import metrics
+
+endpoint = os.environ.get('BOOKWORM_ENDPOINT', 'https://bookworm.htrc.illinois.edu/cgi-bin/dbbindings.py')
+database = os.environ.get('BOOKWORM_DATABASE', 'Bookworm2016')
+transport = Transport.from_env(endpoint)
+fetch_threads = int(os.environ.get('BOOKWORM_FETCH_THREADS', 8))
+# Seconds a page waits for fresh data before falling back to cached data
+callback_deadline = float(os.environ.get('BW_CALLBACK_DEADLINE', 10))
+
+class QuerySpec(object):
+    '''
+    A Bookworm query that can't be modified. `kind` labels the query for
+    logging and metrics (e.g. 'map', 'heatmap', 'bar') and is not sent.
+    '''
+    __slots__ = ('_query', '_key', 'kind')
+
+    def __init__(self, groups=None, search_limits=None, counttype=None,
+                 method='return_json', words_collation='Case_Sensitive',
+                 kind='query', **extra):
+        query = copy.deepcopy(bwypy.BWQuery.default)
+        query['database'] = database
+        query['method'] = method
+        query['words_collation'] = words_collation
+        if groups is not None:
+            query['groups'] = list(groups)
+        if search_limits is not None:
+            query['search_limits'] = copy.deepcopy(search_limits)
+        if counttype is not None:
+            query['counttype'] = list(counttype)
+        query.update(copy.deepcopy(extra))
+        object.__setattr__(self, '_query', query)
+        object.__setattr__(self, '_key', json.dumps(query, sort_keys=True))
+        object.__setattr__(self, 'kind', kind)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("QuerySpec is immutable; use replace()")
+
+    def replace(self, **changes):
+        ''' Return a new spec with some fields changed. '''
+        params = copy.deepcopy(self._query)
+        params.pop('database')
+        params['kind'] = self.kind
+        params.update(changes)
+        return QuerySpec(**params)
+
+    def json(self):
+        ''' A fresh copy of the query, safe to modify. '''
+        return copy.deepcopy(self._query)
+
+    @property
+    def key(self):
+        ''' Canonical string form, equal for equal queries. '''
+        return self._key
+
+    @property
+    def groups(self):
+        return list(self._query['groups'])
+
+    @property
+    def search_limits(self):
+        return copy.deepcopy(self._query['search_limits'])
+
+    @property
+    def counttype(self):
+        return list(self._query['counttype'])
+
+    def __eq__(self, other):
+        return isinstance(other, QuerySpec) and self._key == other._key
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __repr__(self):
+        return "QuerySpec(%s, kind=%r)" % (self._key, self.kind)
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight(object):
+    '''
+    Run at most one call per key at a time. Callers that arrive while a call
+    for their key is running wait for it and share its result (or error).
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key, func, *args, **kwargs):
+        ''' Return (result, shared), where shared is True for a coalesced call. '''
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+inflight = SingleFlight()
+
+def _fetch(spec, timeouts):
+    query = spec.json()
+    # A refresh is meant to see new data, not what this process saw lately
+    response = None if cache.is_refreshing() else planner.answer(query)
+    if response is not None:
+        metrics.counter('bookworm_queries_planned_total', kind=spec.kind).inc()
+        return response
+    response = transport.fetch(query, kind=spec.kind, **timeouts)
+    planner.remember(query, response)
+    return response
+
+def run(spec, **timeouts):
+    '''
+    Run a QuerySpec over the shared transport and return bwypy.BWResults.
+    Nothing is shared between calls, so this is safe to call from many
+    threads at once, and concurrent identical queries only reach the
+    endpoint once. Keyword arguments are passed on to Transport.fetch.
+    '''
+    with metrics.phase('query'):
+        response, shared = inflight.do(canonical_key(spec.json()), _fetch, spec, timeouts)
+    if shared:
+        metrics.counter('bookworm_queries_coalesced_total', kind=spec.kind).inc()
+    # Name result columns after the fields, without the '*' that marks a
+    # group whose limits aren't applied to the denominator
+    query = spec.json()
+    query['groups'] = [group.lstrip('*') for group in query['groups']]
+    return Results(response, query)
+
+class Results(bwypy.BWResults):
+    ''' bwypy.BWResults, with the conversion to a DataFrame timed. '''
+
+    @metrics.timed('frame')
+    def frame(self, *args, **kwargs):
+        return bwypy.BWResults.frame(self, *args, **kwargs)
+
+_pools = {}
+_pool_lock = threading.Lock()
+
+def _get_pool(name, size):
+    with _pool_lock:
+        pool, pid = _pools.get(name, (None, None))
+        # Threads don't survive a fork, so a new process gets a new pool
+        if pool is None or pid != os.getpid():
+            pool = ThreadPoolExecutor(max_workers=size)
+            _pools[name] = (pool, os.getpid())
+        return pool
+
+def submit(func, *args, **kwargs):
+    '''
+    Run func on the shared, bounded fetch pool and return a Future. Use it
+    to run independent queries in parallel.
+    '''
+    return _get_pool('fetch', fetch_threads).submit(metrics.bind(func), *args, **kwargs)
+
+def within_deadline(func, *args, **kwargs):
+    '''
+    Run func, waiting at most callback_deadline seconds for it. Raises
+    concurrent.futures.TimeoutError if it takes longer; func keeps running
+    in the background, so whatever it fetches still reaches the cache.
+    '''
+    # A pool of its own, so that func can itself submit() fetches
+    future = _get_pool('deadline', fetch_threads).submit(metrics.bind(func), *args, **kwargs)
+    return future.result(timeout=callback_deadline)
+
+def fields():
+    ''' All fields in the Bookworm, as a DataFrame. '''
+    response = transport.fetch({'database': database, 'method': 'returnPossibleFields'},
+                               kind='fields')
+    return pd.DataFrame(response)
+
+def field_values(field, n=None):
+    ''' The values of a field, most common first, optionally only the top n. '''
+    spec = QuerySpec(groups=[field], counttype=['TextCount'], kind='field_values')
+    df = run(spec).frame(index=False)
+    values = df.sort_values('TextCount', ascending=False)[field].tolist()
+    return values[:n] if n else values
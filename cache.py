@@ -0,0 +1,518 @@
+# -*- coding: utf-8 -*-
+'''
+A result cache shared by every worker process.
+
+functools.lru_cache keeps a cold cache per gunicorn worker and loses it on
+restart. This cache pickles results into SQLite (default) or into files in a
+local directory, so all workers on a machine share them and they survive
+restarts. Entries have a TTL, the store is trimmed to a byte budget by
+evicting the least recently used entries, and hits and misses are counted.
+Eviction runs every BW_CACHE_EVICT_INTERVAL seconds, or sooner after a
+tenth of the budget has been written, rather than on every write, and an
+entry's recency is only updated once a minute however often it is read.
+
+An entry past its TTL isn't dropped straight away. For BW_CACHE_STALE_TTL
+more seconds it is still served, while a fresh value is fetched in the
+background (stale-while-revalidate). After that it is kept until
+BW_CACHE_KEEP as a last known good value, for callers that can't get a
+fresh one in time (see `last_known`).
+
+Configured through the environment:
+
+    BW_CACHE_BACKEND    'sqlite' or 'disk' (default: sqlite)
+    BW_CACHE_PATH       database file or directory (default: cache/results.db
+                        or cache/results)
+    BW_CACHE_MAX_BYTES  byte budget before eviction (default: 512MB)
+    BW_CACHE_TTL        default time to live, in seconds (default: one day)
+    BW_CACHE_STALE_TTL  seconds past the TTL a value is served while it is
+                        refreshed (default: one day)
+    BW_CACHE_KEEP       seconds past the TTL a value is kept as a fallback
+                        (default: 30 days)
+    BW_CACHE_EVICT_INTERVAL  seconds between evictions (default: 60)
+'''
+import os
+import time
+import struct
+import pickle
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import functools
+import logging
+
+# Seconds an entry's recency may lag behind its last read
+touch_interval = 60
+
+class SQLiteBackend(object):
+    ''' Entries in one SQLite table. Safe across threads and processes. '''
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        conn = self._conn()
+        conn.execute('''CREATE TABLE IF NOT EXISTS entries (
+                            key TEXT PRIMARY KEY, value BLOB, size INTEGER,
+                            expires REAL, accessed REAL)''')
+        conn.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+        conn.commit()
+
+    def _conn(self):
+        # Connections must not cross threads or a fork, so keep one per
+        # thread and reopen if the pid changed.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        conn = self._conn()
+        row = conn.execute('SELECT value, expires, accessed FROM entries WHERE key = ?',
+                           (key,)).fetchone()
+        if row is None:
+            return None
+        # Every write takes the database lock, so don't write on every hit
+        now = time.time()
+        if now - row[2] > touch_interval:
+            with conn:
+                conn.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+        return bytes(row[0]), row[1]
+
+    def expires(self, key):
+        row = self._conn().execute('SELECT expires FROM entries WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def set(self, key, blob, expires):
+        conn = self._conn()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                         (key, sqlite3.Binary(blob), len(blob), expires, time.time()))
+
+    def delete(self, key):
+        conn = self._conn()
+        with conn:
+            conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def size(self):
+        return self._conn().execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def evict(self, max_bytes):
+        ''' Drop expired entries, then the least recently used, until under budget. '''
+        conn = self._conn()
+        with conn:
+            conn.execute('DELETE FROM entries WHERE expires < ?', (time.time(),))
+        total = self.size()
+        if total <= max_bytes:
+            return 0
+        evicted = 0
+        rows = conn.execute('SELECT key, size FROM entries ORDER BY accessed ASC').fetchall()
+        with conn:
+            for key, size in rows:
+                if total <= max_bytes:
+                    break
+                conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+                total -= size
+                evicted += 1
+        return evicted
+
+class DiskBackend(object):
+    '''
+    One file per entry: its expiry time, then the blob. Recency is tracked
+    with the file mtime.
+    '''
+    suffix = '.entry'
+    header = struct.Struct('<d')
+    # Entries in the old format, a pickle of (expires, blob), are evicted
+    old_suffix = '.pkl'
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, key + self.suffix)
+
+    def get(self, key):
+        fname = self._file(key)
+        try:
+            with open(fname, 'rb') as f:
+                data = f.read()
+                if time.time() - os.fstat(f.fileno()).st_mtime > touch_interval:
+                    os.utime(fname, None)
+        except (IOError, OSError):
+            return None
+        if len(data) < self.header.size:
+            return None
+        return data[self.header.size:], self.header.unpack_from(data)[0]
+
+    def _expires(self, fname):
+        with open(fname, 'rb') as f:
+            data = f.read(self.header.size)
+        return self.header.unpack(data)[0] if len(data) == self.header.size else None
+
+    def expires(self, key):
+        try:
+            return self._expires(self._file(key))
+        except (IOError, OSError):
+            return None
+
+    def set(self, key, blob, expires):
+        # Write to a temporary file and rename, so that readers in other
+        # processes never see a partial entry.
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.header.pack(expires))
+            f.write(blob)
+        os.replace(tmp, self._file(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._file(key))
+        except OSError:
+            pass
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith((self.suffix, self.old_suffix)):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self, max_bytes):
+        ''' Drop expired entries, then the least recently used, until under budget. '''
+        now = time.time()
+        entries = []
+        evicted = 0
+        for entry in self._entries():
+            fname = os.path.join(self.path, entry[2])
+            try:
+                expires = self._expires(fname) if fname.endswith(self.suffix) else None
+                if expires is None or expires < now:
+                    os.remove(fname)
+                    evicted += 1
+                    continue
+            except (IOError, OSError):
+                continue
+            entries.append(entry)
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+        return evicted
+
+# Bump when the format of entries changes, so old entries are never read
+key_version = 3
+
+# What lookup() found
+FRESH, STALE, EXPIRED = 'fresh', 'stale', 'expired'
+
+class ResultCache(object):
+
+    def __init__(self, backend, max_bytes=512*1024*1024, default_ttl=24*3600,
+                 stale_ttl=24*3600, keep=30*24*3600, evict_interval=60):
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.stale_ttl = stale_ttl
+        self.keep = max(keep, stale_ttl)
+        self.evict_interval = evict_interval
+        self._lock = threading.Lock()
+        self._counts = {}
+        # Bytes written since the last eviction, and when that was
+        self._written = 0
+        self._evicted = time.time()
+
+    @classmethod
+    def from_env(cls):
+        kind = os.environ.get('BW_CACHE_BACKEND', 'sqlite')
+        if kind == 'disk':
+            backend = DiskBackend(os.environ.get('BW_CACHE_PATH', os.path.join('cache', 'results')))
+        elif kind == 'sqlite':
+            backend = SQLiteBackend(os.environ.get('BW_CACHE_PATH', os.path.join('cache', 'results.db')))
+        else:
+            raise ValueError("Unknown cache backend: %s" % kind)
+        return cls(backend,
+                   max_bytes=int(os.environ.get('BW_CACHE_MAX_BYTES', 512*1024*1024)),
+                   default_ttl=float(os.environ.get('BW_CACHE_TTL', 24*3600)),
+                   stale_ttl=float(os.environ.get('BW_CACHE_STALE_TTL', 24*3600)),
+                   keep=float(os.environ.get('BW_CACHE_KEEP', 30*24*3600)),
+                   evict_interval=float(os.environ.get('BW_CACHE_EVICT_INTERVAL', 60)))
+
+    def _count(self, namespace, outcome):
+        with self._lock:
+            counts = self._counts.setdefault(namespace, {'hits': 0, 'misses': 0, 'stale': 0})
+            counts[outcome] += 1
+
+    def stats(self):
+        '''
+        Hit, miss and stale hit counts for this process, by namespace and in
+        total.
+        '''
+        with self._lock:
+            stats = {ns: dict(counts) for ns, counts in self._counts.items()}
+        stats['total'] = {outcome: sum(c[outcome] for c in stats.values())
+                          for outcome in ('hits', 'misses', 'stale')}
+        stats['total']['bytes'] = self.backend.size()
+        return stats
+
+    @staticmethod
+    def make_key(namespace, args, kwargs):
+        raw = repr((key_version, namespace, args, sorted(kwargs.items())))
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def lookup(self, key):
+        '''
+        Return (state, value): FRESH within the TTL, STALE for a while after
+        it, EXPIRED while it is still kept after that, or (None, None) if
+        there is no entry. Nothing is counted.
+        '''
+        try:
+            entry = self.backend.get(key)
+        except Exception:
+            logging.exception("Cache read failed")
+            entry = None
+        if entry is None:
+            return None, None
+        blob, expires = entry
+        now = time.time()
+        if expires < now:
+            return None, None
+        try:
+            fresh_until, value = pickle.loads(blob)
+        except Exception:
+            logging.exception("Dropping unreadable cache entry")
+            self.backend.delete(key)
+            return None, None
+        if now <= fresh_until:
+            return FRESH, value
+        elif now <= fresh_until + self.stale_ttl:
+            return STALE, value
+        return EXPIRED, value
+
+    def fresh_until(self, key):
+        '''
+        When the entry for key stops being fresh, or None if there is none.
+        It changes every time a value is set, and is read without
+        unpickling the value.
+        '''
+        try:
+            expires = self.backend.expires(key)
+        except Exception:
+            logging.exception("Cache read failed")
+            return None
+        if expires is None or expires < time.time():
+            return None
+        return expires - self.keep
+
+    def state(self, key):
+        ''' The state lookup() would return for key, without loading the value. '''
+        fresh_until = self.fresh_until(key)
+        if fresh_until is None:
+            return None
+        now = time.time()
+        if now <= fresh_until:
+            return FRESH
+        elif now <= fresh_until + self.stale_ttl:
+            return STALE
+        return EXPIRED
+
+    def get(self, key, namespace='default'):
+        ''' Return (True, value) on a fresh hit, (False, None) otherwise. '''
+        state, value = self.lookup(key)
+        if state == FRESH:
+            self._count(namespace, 'hits')
+            return True, value
+        self._count(namespace, 'misses')
+        return False, None
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.default_ttl
+        fresh_until = time.time() + ttl
+        try:
+            blob = pickle.dumps((fresh_until, value), pickle.HIGHEST_PROTOCOL)
+            self.backend.set(key, blob, fresh_until + self.keep)
+            if self._eviction_due(len(blob)):
+                self.backend.evict(self.max_bytes)
+        except Exception:
+            # A failing cache should never take a page down with it
+            logging.exception("Cache write failed")
+
+    def _eviction_due(self, written):
+        # An eviction scans the whole store, so only run one now and then,
+        # or once enough has been written to matter
+        with self._lock:
+            self._written += written
+            now = time.time()
+            if now - self._evicted < self.evict_interval and self._written < self.max_bytes / 10:
+                return False
+            self._written = 0
+            self._evicted = now
+            return True
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+def get_cache():
+    ''' The process-wide cache, opened from the environment on first use. '''
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache.from_env()
+    return _result_cache
+
+# Every cached function by namespace, so calls can be replayed (see warmer.py)
+registry = {}
+# Called as listener(namespace, key, args, kwargs) on every call of a cached function
+listeners = []
+
+def _notify(namespace, key, args, kwargs):
+    for listener in listeners:
+        try:
+            listener(namespace, key, args, kwargs)
+        except Exception:
+            logging.exception("Cache listener failed")
+
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+_local = threading.local()
+
+def is_refreshing():
+    '''
+    Whether this thread is fetching a value to replace a cached one. Such a
+    value should come from the source, not from any shortcut in memory.
+    '''
+    return getattr(_local, 'refreshing', False)
+
+def _refetch(func, args, kwargs):
+    previous = is_refreshing()
+    _local.refreshing = True
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _local.refreshing = previous
+
+def _refresh_in_background(cache, key, ttl, func, args, kwargs):
+    # One refresh per key at a time in this process
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    def target():
+        try:
+            cache.set(key, _refetch(func, args, kwargs), ttl)
+        except Exception:
+            logging.exception("Background refresh of %s failed", func.__name__)
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(key)
+    threading.Thread(target=target, name='cache-refresh', daemon=True).start()
+
+def cached(ttl=None, namespace=None):
+    '''
+    Decorator: a shared, persistent stand-in for functools.lru_cache.
+    Arguments must have a stable repr, which is true of the strings and
+    numbers our data fetchers take.
+
+    A stale value is returned straight away and refreshed in the
+    background. `func.last_known(*args)` returns whatever value is kept for
+    those arguments, however old, and raises KeyError if there is none.
+    `func.refresh(*args)` fetches and caches a new value,
+    `func.is_fresh(*args)` says whether the cached one is within its TTL,
+    and `func.is_servable(*args)` whether a call would be answered from the
+    cache, fresh or stale, without waiting for func.
+
+    `func.version(*args)` changes whenever a new value is cached for those
+    arguments. Key in-memory results derived from the value on it, so that
+    they are rebuilt after an expiry or refresh. Like a call, it fetches a
+    missing value, starts refreshing a stale one and is seen by listeners.
+    It is None if the value couldn't be cached; don't memoise on that.
+    '''
+    def decorator(func):
+        ns = namespace or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            cache = get_cache()
+            key = cache.make_key(ns, args, kwargs)
+            _notify(ns, key, args, kwargs)
+            state, value = cache.lookup(key)
+            if state == FRESH:
+                cache._count(ns, 'hits')
+                return value
+            elif state == STALE:
+                cache._count(ns, 'stale')
+                _refresh_in_background(cache, key, ttl, func, args, kwargs)
+                return value
+            cache._count(ns, 'misses')
+            value = func(*args, **kwargs)
+            cache.set(key, value, ttl)
+            return value
+
+        def last_known(*args, **kwargs):
+            cache = get_cache()
+            state, value = cache.lookup(cache.make_key(ns, args, kwargs))
+            if state is None:
+                raise KeyError("Nothing cached for %s%r" % (func.__name__, args))
+            cache._count(ns, 'stale')
+            return value
+
+        def refresh(*args, **kwargs):
+            ''' Call func and cache its value, whatever is cached now. '''
+            value = _refetch(func, args, kwargs)
+            get_cache().set(get_cache().make_key(ns, args, kwargs), value, ttl)
+            return value
+
+        def is_fresh(*args, **kwargs):
+            cache = get_cache()
+            return cache.lookup(cache.make_key(ns, args, kwargs))[0] == FRESH
+
+        def is_servable(*args, **kwargs):
+            cache = get_cache()
+            return cache.state(cache.make_key(ns, args, kwargs)) in (FRESH, STALE)
+
+        def version(*args, **kwargs):
+            # Fetch, or start refreshing, a value that isn't fresh, as a call would
+            cache = get_cache()
+            key = cache.make_key(ns, args, kwargs)
+            fresh_until = cache.fresh_until(key)
+            if fresh_until is None or fresh_until < time.time():
+                wrapper(*args, **kwargs)
+                fresh_until = cache.fresh_until(key)
+            else:
+                # It stands in for a call, so it counts as one
+                _notify(ns, key, args, kwargs)
+            return fresh_until
+
+        wrapper.namespace = ns
+        wrapper.last_known = last_known
+        wrapper.refresh = refresh
+        wrapper.is_fresh = is_fresh
+        wrapper.is_servable = is_servable
+        wrapper.version = version
+        registry[ns] = wrapper
+        return wrapper
+    return decorator
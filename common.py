@@ -3,10 +3,23 @@
 A common server than can be imported, rather than indivudally initialized.
 '''
 import dash
-import bwypy
+from instrument import instrument
 
 app = dash.Dash(url_base_pathname='/app/', csrf_protect=False)
 app.config.supress_callback_exceptions = True
+# Time every callback, and serve metrics at /app/metrics
+instrument(app)
+
+# Dash already wraps the server in Flask-Compress. Compress every callback
+# response that is worth it, with brotli where the installed Flask-Compress
+# supports it (1.5+, with the brotli package) and gzip otherwise.
+app.server.config.update(
+    COMPRESS_MIMETYPES=['application/json', 'text/html', 'text/css',
+                        'application/javascript', 'text/plain'],
+    COMPRESS_ALGORITHM=['br', 'gzip'],
+    COMPRESS_LEVEL=6,
+    COMPRESS_MIN_SIZE=500
+)
 
 app.css.append_css({
     "external_url" : "https://maxcdn.bootstrapcdn.com/bootstrap/4.0.0-beta/css/bootstrap.min.css"
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+'''
+Example books for a selection on a map or heatmap.
+
+Bookworm's search_results method returns every matching book in one
+response. It is fetched once per (limits, words), kept in the result cache
+and shown a page at a time, so "Load more" and repeated clicks on the same
+place never go back to the endpoint. Only the books on the pages shown are
+parsed.
+
+    BW_EXAMPLES_PAGE_SIZE  books per page (default: 10)
+    BW_EXAMPLES_MAX        books kept per search (default: 100)
+'''
+import os
+import re
+import json
+import logging
+import dash_html_components as html
+from cache import cached
+from bookworm import QuerySpec, run
+
+page_size = int(os.environ.get('BW_EXAMPLES_PAGE_SIZE', 10))
+max_results = int(os.environ.get('BW_EXAMPLES_MAX', 100))
+
+bw_html = QuerySpec(method='search_results', words_collation='case_insensitive', kind='search_results')
+
+# <a href=URL><em>TITLE</em> (YEAR)</a>
+_book = re.compile(r"href=(.*?)><em>(.*?)</em> \((.*?)\)")
+
+def _key(limits, words):
+    # Canonical forms, so that the same selection always has the same cache key
+    return json.dumps(limits, sort_keys=True), tuple(sorted(set(w.strip() for w in words if w.strip())))
+
+@cached(namespace='examples')
+def _search_results(limits, words):
+    spec = bw_html.replace(search_limits=dict(json.loads(limits), word=list(words)))
+    return run(spec).json()[:max_results]
+
+def search_results(limits, words):
+    ''' The raw search results for some search limits and words, cached. '''
+    return _search_results(*_key(limits, words))
+
+def parse(result):
+    ''' (url, title, year) for one search result, or None if it can't be read. '''
+    match = _book.search(result)
+    return match.groups() if match else None
+
+def books(limits, words, pages=1):
+    '''
+    The books on the first `pages` pages of results, as (url, title, year),
+    and whether there are more.
+    '''
+    results = search_results(limits, words)
+    shown = results[:pages * page_size]
+    parsed = [parse(result) for result in shown]
+    unreadable = parsed.count(None)
+    if unreadable:
+        logging.warning("%d search results could not be parsed", unreadable)
+    return [book for book in parsed if book], len(results) > len(shown)
+
+def book_list(limits, words, pages=1):
+    ''' A list of links to the books on the first `pages` pages of results. '''
+    found, more = books(limits, words, pages)
+    if not found:
+        return html.Ul(html.Li(html.Em("No matching books")))
+    links = [html.Li(html.A(href=url, target='_blank', children=["%s (%s)" % (title, year)]))
+             for url, title, year in found]
+    if more:
+        links.append(html.Li(html.Em("Load more to see further books")))
+    return html.Ul(links)
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+'''
+Facet metadata served from a local snapshot.
+
+The fields in the Bookworm, and the most common values of each character
+field, rarely change. Instead of asking the endpoint every time a page is
+built or a dropdown is filled, they are fetched together, kept in a JSON
+file and served from memory. An old snapshot is still served while a fresh
+one is fetched in the background. When there is no snapshot at all, the
+fields the pages use are served, without values, while the first one is
+fetched. The snapshot is generated, not versioned.
+
+To fetch a new snapshot, or see how old the current one is:
+
+    python facets.py refresh
+    python facets.py status
+
+    BW_FACET_SNAPSHOT  snapshot file (default: data/facets.json)
+    BW_FACET_MAX_AGE   seconds before a snapshot is refreshed (default: 30 days)
+    BW_FACET_TOP_N     values kept per field (default: 100)
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import logging
+import bookworm
+
+# Served until there is a snapshot: the fields the pages default to and map
+fallback = {
+    'created': 0,
+    'top_n': 0,
+    'fields': [{'name': name, 'type': 'character'}
+               for name in ['class', 'language', 'publication_country', 'publication_state']],
+    'values': {}
+}
+
+class FacetStore(object):
+
+    def __init__(self, path, max_age=30*24*3600, top_n=100, retry_after=60):
+        self.path = path
+        self.max_age = max_age
+        self.top_n = top_n
+        # Seconds before a failed background refresh is tried again
+        self.retry_after = retry_after
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._attempted = 0
+        # Off while a process must not start threads (see preload.py): a
+        # stale snapshot isn't refreshed, and a missing one is fetched serially
+        # rather than served from the fallback
+        self.background_refresh = True
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write(self, snapshot):
+        dirname = os.path.dirname(self.path) or '.'
+        fd, tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(snapshot, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def refresh(self):
+        '''
+        Fetch the metadata from the endpoint and save a new snapshot. The
+        values of each field are fetched in parallel, unless this process
+        must not start threads.
+        '''
+        df = bookworm.fields()
+        fields = df[['name', 'type']].to_dict('records')
+        character = [f['name'] for f in fields if f['type'] == 'character']
+        if self.background_refresh:
+            futures = {name: bookworm.submit(bookworm.field_values, name, self.top_n)
+                       for name in character}
+            values = {name: future.result() for name, future in futures.items()}
+        else:
+            values = {name: bookworm.field_values(name, self.top_n) for name in character}
+        snapshot = {
+            'created': time.time(),
+            'top_n': self.top_n,
+            'fields': fields,
+            'values': {name: [str(v) for v in field_values] for name, field_values in values.items()}
+        }
+        self._write(snapshot)
+        with self._lock:
+            self._snapshot = snapshot
+        return snapshot
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing or time.time() - self._attempted < self.retry_after:
+                return
+            self._refreshing = True
+            self._attempted = time.time()
+
+        def target():
+            try:
+                self.refresh()
+            except Exception:
+                logging.exception("Facet metadata refresh failed")
+            finally:
+                with self._lock:
+                    self._refreshing = False
+        threading.Thread(target=target, name='facet-refresh', daemon=True).start()
+
+    def snapshot(self):
+        '''
+        The snapshot in memory, loading it first. If there is none, the
+        fallback while one is fetched in the background.
+        '''
+        with self._lock:
+            snapshot = self._snapshot
+        if snapshot is None:
+            snapshot = self._read()
+            if snapshot is None:
+                if not self.background_refresh:
+                    return self.refresh()
+                self._refresh_in_background()
+                return fallback
+            with self._lock:
+                self._snapshot = snapshot
+        if self._is_stale(snapshot) and self.background_refresh:
+            self._refresh_in_background()
+        return snapshot
+
+    def _is_stale(self, snapshot):
+        return (time.time() - snapshot['created'] > self.max_age or
+                snapshot.get('top_n', 0) < self.top_n or 'values' not in snapshot)
+
+    def age(self):
+        ''' Seconds since the snapshot on disk was made, or None if there is none. '''
+        snapshot = self._read()
+        return None if snapshot is None else time.time() - snapshot['created']
+
+    def stale(self):
+        ''' Whether the snapshot on disk is missing, too old or incomplete. '''
+        snapshot = self._read()
+        return snapshot is None or self._is_stale(snapshot)
+
+    def fields(self, type=None):
+        ''' Field names, optionally only those of one type (e.g. 'character'). '''
+        return [f['name'] for f in self.snapshot()['fields']
+                if type is None or f['type'] == type]
+
+    def values(self, field, n=None):
+        '''
+        The most common values of a character field, most common first.
+        Unknown fields have no values.
+        '''
+        values = self.snapshot().get('values', {}).get(field, [])
+        return values[:n] if n else values
+
+store = FacetStore(os.environ.get('BW_FACET_SNAPSHOT', os.path.join('data', 'facets.json')),
+                   max_age=float(os.environ.get('BW_FACET_MAX_AGE', 30*24*3600)),
+                   top_n=int(os.environ.get('BW_FACET_TOP_N', 100)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the facet metadata snapshot.")
+    parser.add_argument('command', choices=['refresh', 'status'])
+    args = parser.parse_args(argv)
+
+    if args.command == 'refresh':
+        snapshot = store.refresh()
+        print("Saved %d fields and values for %d to %s" % (
+            len(snapshot['fields']), len(snapshot['values']), store.path))
+    else:
+        age = store.age()
+        if age is None:
+            print("No snapshot at %s" % store.path)
+        else:
+            print("%s is %.1f days old%s" % (store.path, age / 86400.,
+                                             " and stale" if store.stale() else ""))
+        return 1 if store.stale() else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+'''
+Compact encoding of figures before they are sent to the browser.
+
+Plotly's JSON encoder writes NumPy arrays and pandas Series at full float
+precision (e.g. 0.30000000000000004), and whole-number floats with a trailing
+'.0'. compact() rounds floats to what can actually be seen on a plot, relative
+to the largest value of each array so that small values aren't lost, writes
+whole numbers as integers and turns arrays into plain lists, which often
+halves the size of a figure before compression.
+'''
+import numpy as np
+import pandas as pd
+import metrics
+
+# Digits kept of the largest value in an array, however small it is
+significant = 4
+
+def _places(values, decimals):
+    # `decimals`, or more if the array's largest value needs them to keep
+    # its significant digits (e.g. words per million of a rare word)
+    magnitude = np.abs(values[np.isfinite(values)])
+    if magnitude.size == 0 or magnitude.max() == 0:
+        return decimals
+    return max(decimals, significant - 1 - int(np.floor(np.log10(magnitude.max()))))
+
+def _compact_array(values, decimals):
+    values = np.asarray(values)
+    if values.dtype.kind == 'f':
+        # Rounding to tens or more multiplies by a power of ten that isn't
+        # exact (1e20 comes back as 9.999999999999998e+19), and wouldn't
+        # shorten those numbers anyway
+        rounded = np.round(values, max(_places(values, decimals), 0))
+        finite = np.isfinite(rounded)
+        if finite.all() and (rounded == np.floor(rounded)).all() and \
+                (rounded.size == 0 or np.abs(rounded).max() < 2**53):
+            return rounded.astype(np.int64).tolist()
+        out = rounded.astype(object)
+        out[~finite] = None
+        return out.tolist()
+    if values.dtype.kind in 'iubUS':
+        return values.tolist()
+    return [_compact(v, decimals) for v in values.tolist()]
+
+def _compact(obj, decimals):
+    if isinstance(obj, dict):
+        return {k: _compact(v, decimals) for k, v in obj.items()}
+    if isinstance(obj, (pd.Series, pd.Index)):
+        return _compact_array(obj.values, decimals)
+    if isinstance(obj, np.ndarray):
+        return _compact_array(obj, decimals)
+    if isinstance(obj, (list, tuple)):
+        if obj and all(isinstance(v, (int, float, np.number)) and not isinstance(v, bool) for v in obj):
+            return _compact_array(obj, decimals)
+        return [_compact(v, decimals) for v in obj]
+    if isinstance(obj, (float, np.floating)):
+        return _compact_array([obj], decimals)[0]
+    if isinstance(obj, np.integer):
+        return int(obj)
+    return obj
+
+@metrics.timed('encode')
+def compact(obj, decimals=3):
+    '''
+    A copy of a figure (or any part of one) with numeric arrays rounded to
+    `decimals` places, or to as many more as keep `significant` digits of
+    an array's largest value, and converted to lists. Dicts, including plotly graph
+    objects, become plain dicts.
+    '''
+    return _compact(obj, decimals)
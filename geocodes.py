@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+'''
+Place name to map code lookup.
+
+The code tables in data/ (country name to ISO-3 code, US state name to USPS
+code) are read once into a dict per field. Names that Bookworm spells
+differently from the tables are resolved through data/code_aliases.csv, and
+otherwise matched ignoring case and surrounding spaces.
+
+An alias must be another spelling of the same place. Places within another
+one, such as England and Scotland, are left without a code: they would be
+drawn over each other, and a rate per million words can't be combined
+without the totals behind it.
+'''
+import os
+import logging
+import numpy as np
+import pandas as pd
+
+here = os.path.dirname(os.path.abspath(__file__))
+tables = {
+    'publication_country': os.path.join(here, 'data', 'country_codes.csv'),
+    'publication_state': os.path.join(here, 'data', 'state_codes_us.csv')
+}
+aliases_path = os.path.join(here, 'data', 'code_aliases.csv')
+
+def _normalize(names):
+    return names.str.strip().str.lower()
+
+class CodeIndex(object):
+    ''' Codes for the values of one field. '''
+
+    def __init__(self, names, codes, aliases=None):
+        self.index = dict(zip(names, codes))
+        if aliases:
+            for alias, name in aliases.items():
+                if name in self.index:
+                    self.index.setdefault(alias, self.index[name])
+        keys = pd.Series(list(self.index.keys()))
+        self.normalized = dict(zip(_normalize(keys), self.index.values()))
+
+    def codes(self, names):
+        '''
+        The code for each name in a Series, NaN where there is none. Each
+        distinct name is looked up once.
+        '''
+        labels, uniques = pd.factorize(names.values)
+        found = pd.Series(uniques).map(self.index).values.astype(object)
+        missing = pd.isnull(found)
+        if missing.any():
+            found[missing] = _normalize(pd.Series(uniques[missing]).astype(str)).map(self.normalized).values
+            unmatched = uniques[pd.isnull(found)]
+            if len(unmatched):
+                logging.debug("No map code for %s", ', '.join(str(name) for name in unmatched))
+        codes = np.where(labels >= 0, found[labels], np.nan)
+        return pd.Series(codes, index=names.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+_indexes = {}
+
+def index(field):
+    ''' The CodeIndex for a field, read on first use. '''
+    if field not in _indexes:
+        table = pd.read_csv(tables[field])
+        aliases = pd.read_csv(aliases_path)
+        aliases = aliases[aliases.field == field]
+        _indexes[field] = CodeIndex(table[field].values, table['code'].values,
+                                    dict(zip(aliases.alias, aliases.name)))
+    return _indexes[field]
+
+def with_codes(df, field):
+    ''' df with a `code` column for `field`, without rows that have no code. '''
+    codes = index(field).codes(df[field])
+    keep = codes.notnull().values
+    return df[keep].assign(code=codes[keep].values)
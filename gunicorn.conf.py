@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+'''
+gunicorn settings for preload-and-fork mode (see preload.py):
+
+    gunicorn -c gunicorn.conf.py app:server
+
+Workers and threads can still be set on the command line or with
+WEB_CONCURRENCY, e.g. `gunicorn -c gunicorn.conf.py --threads 8 app:server`.
+'''
+import os
+import sys
+
+# gunicorn reads this file before it puts the working directory on
+# sys.path, so make the app's modules importable from here
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import preload
+
+preload_app = True
+preload.enable()
+
+def post_fork(server, worker):
+    preload.after_fork()
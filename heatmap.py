@@ -2,18 +2,23 @@
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import  State, Input, Output
-import plotly
+from dash.dependencies import  State, Event, Input, Output
 import plotly.graph_objs as go
-import pandas as pd
+import os
+import math
 import functools
+from cache import cached
 from common import app
 from common import graphconfig
-import bwypy
-import numpy as np
-import pandas as pd
-import itertools
+from bookworm import QuerySpec, run, within_deadline
+import facets
 import json
+import matrix
+import metrics
+import figures
+import examples
+import warmer
+import jobs
 from tools import get_facet_group_options, pretty_facet, errorfig, logging_config
 import logging
 from logging.config import dictConfig
@@ -23,78 +28,191 @@ logger = logging.getLogger()
 
 app.config.supress_callback_exceptions=True
 
-bwypy.set_options(database='Bookworm2016', endpoint='https://bookworm.htrc.illinois.edu/cgi-bin/dbbindings.py')
-bw_heatmap = bwypy.BWQuery(verify_fields=False)
-bw_heatmap.counttype = ['WordsPerMillion']
-bw_heatmap.json['words_collation'] = 'case_insensitive'
-
-bw_html = bwypy.BWQuery(verify_fields=False)
-bw_html.json['method'] = 'search_results'
-bw_html.json['words_collation'] = 'case_insensitive'
+# Base queries. Each call derives its own spec from these with replace()
+bw_heatmap = QuerySpec(counttype=['WordsPerMillion'], words_collation='case_insensitive', kind='heatmap')
 
 hard_min_year = 1650
 hard_max_year = 2015
 default_min_year = 1900
 default_max_year = 2000
+default_word = 'computer'
+default_facet = 'class'
+# Facet values fetched per heatmap; the facet value dropdown offers as many
+max_facet_values = 60
+
+# Level of detail: when a heatmap would have more cells than the budget, years
+# are averaged into the narrowest of these bins that brings it under budget.
+# Zooming in on the plot shows the zoomed years at full resolution again.
+cell_budget = int(os.environ.get('BW_HEATMAP_CELL_BUDGET', 4000))
+bin_widths = (1, 5, 10, 25)
 
 header = '''
 # Bookworm Heatmap
 See where a word occurs across facets.
 '''
 
-facet_opts = get_facet_group_options(bw_heatmap)
+facet_opts = get_facet_group_options()
 
-@functools.lru_cache(maxsize=32)
+@cached()
 def get_heatmap_values(query, facet, max_facet_values=15, hard_min_year=1650, hard_max_year=2015):
     words = [token.strip() for token in query.split(',')]
-    bw_heatmap.search_limits = { 'word': words, facet+'__id': { '$lt':max_facet_values+1 }, 
-                        'date_year': { '$lt': hard_max_year, '$gt': hard_min_year } }
-    bw_heatmap.groups = [facet, 'date_year']
+    spec = bw_heatmap.replace(search_limits={ 'word': words, facet+'__id': { '$lt':max_facet_values+1 },
+                                              'date_year': { '$lt': hard_max_year, '$gt': hard_min_year } },
+                              groups=[facet, 'date_year'])
 
     # Get and format results
-    results = bw_heatmap.run()
+    results = run(spec)
     df = results.frame(index=False, drop_unknowns=True)
     df.date_year = df.date_year.astype(float).astype(int)
     df = df[df[facet] != '0']
     return df
 
+def get_heatmap_matrix(query, facet, max_facet_values, log, smoothing):
+    '''
+    The fully prepared heatmap over hard_min_year..hard_max_year, kept in
+    memory so that moving the year slider or changing the facet values only
+    slices it. It is rebuilt whenever the cached results change.
+    '''
+    version = get_heatmap_values.version(query, facet, max_facet_values,
+                                         hard_min_year=hard_min_year, hard_max_year=hard_max_year)
+    if version is None:
+        # Nothing is cached to tell when the matrix would be out of date
+        return _heatmap_matrix.__wrapped__(query, facet, max_facet_values, log, smoothing, version)
+    return _heatmap_matrix(query, facet, max_facet_values, log, smoothing, version)
+
+@functools.lru_cache(maxsize=64)
+def _heatmap_matrix(query, facet, max_facet_values, log, smoothing, version):
+    # version is the cached results' version (see cache.cached)
+    df = get_heatmap_values(query, facet, max_facet_values,
+                            hard_min_year=hard_min_year, hard_max_year=hard_max_year)
+    return matrix.Matrix.from_frame(df, facet, 'date_year', 'WordsPerMillion',
+                                    hard_min_year, hard_max_year, log=log, smoothing=smoothing)
+
+# The default heatmap is always served from a warm cache
+warmer.keep_warm(get_heatmap_values, default_word, default_facet, max_facet_values,
+                 hard_min_year=hard_min_year, hard_max_year=hard_max_year)
+
+def get_stale_heatmap_matrix(query, facet, max_facet_values, log, smoothing):
+    ''' The same heatmap from the last known cached results, however old. '''
+    df = get_heatmap_values.last_known(query, facet, max_facet_values,
+                                       hard_min_year=hard_min_year, hard_max_year=hard_max_year)
+    return matrix.Matrix.from_frame(df, facet, 'date_year', 'WordsPerMillion',
+                                    hard_min_year, hard_max_year, log=log, smoothing=smoothing)
+
 def format_heatmap_data(data, word, log, smoothing, soft_min_year, soft_max_year, facet_query=None):
+    '''
+    Build the heatmap from long results. `smoothing` is the width, in years,
+    of the trailing moving average applied to each facet value separately
+    (0 or None for no smoothing).
+    '''
     facet = data.columns.values[0]
-    if log:
-        data.WordsPerMillion = data.WordsPerMillion.add(1).apply(np.log)
-    if (facet_query is not None) and (len(facet_query) != 0):
-        data = data[data[facet].isin(list(facet_query))]
-    years = pd.Series(range(soft_min_year,soft_max_year))
-    fullyears = pd.Series(range(data.date_year.min(),data.date_year.max()))
-    all_keys = pd.DataFrame(list(itertools.product(data[facet].unique(), fullyears)), columns=[facet, 'date_year'])
-
-    df2 = pd.merge(all_keys, data, how='left').fillna(0)
-    if smoothing:
-        df2.WordsPerMillion = df2.WordsPerMillion.rolling(5, min_periods=1).mean()
-    df2 = df2[(df2.date_year > soft_min_year) & (df2.date_year < soft_max_year)]
-
-    groups = df2.groupby(facet)
-    labels = []
-    counts = []
-    for g in groups:
-        labels.append(g[0])
-        counts.append(g[1]['WordsPerMillion'])
-        
-    data = [go.Heatmap(z=counts,
-                   x=years,
-                   y=labels,
+    # Cover the requested years so that the window is always full width
+    m = matrix.Matrix.from_frame(data, facet, 'date_year', 'WordsPerMillion',
+                                 soft_min_year, soft_max_year, log=log, smoothing=smoothing)
+    return heatmap_figure(m.select(facet_query, soft_min_year, soft_max_year), word, facet)
+
+def level_of_detail(n_rows, min_year, max_year):
+    ''' Width, in years, of the bins that keep a heatmap within the cell budget. '''
+    n_years = max_year - min_year + 1
+    for width in bin_widths:
+        if n_rows * int(math.ceil(n_years / float(width))) <= cell_budget:
+            return width
+    return bin_widths[-1]
+
+def visible_rows(word, facet, facet_query):
+    '''
+    How many rows the heatmap shows, counted from the last known results so
+    that it never waits on a query. If there are none, the most it can show.
+    '''
+    try:
+        df = get_heatmap_values.last_known(word, facet, max_facet_values,
+                                           hard_min_year=hard_min_year, hard_max_year=hard_max_year)
+        labels = set(df[facet])
+    except Exception:
+        return len(set(facet_query)) if facet_query else max_facet_values
+    return len(labels & set(facet_query)) if facet_query else len(labels)
+
+def heatmap_inputs(word, facet, facet_query, years):
+    ''' What the heatmap is drawn for, in the form a zoom records it. '''
+    return [word, facet, list(facet_query or []), list(years)]
+
+def zoom_after(relayout, zoom, inputs):
+    '''
+    The zoom to keep after the heatmap is relaid out, as JSON: the x range
+    zoomed in on, or None when zoomed out, and the heatmap inputs it was
+    made on. A relayout that doesn't touch the x axis, such as the initial
+    autosize, keeps the zoom as it was.
+    '''
+    relayout = relayout or {}
+    if 'xaxis.range[0]' in relayout and 'xaxis.range[1]' in relayout:
+        x = [relayout['xaxis.range[0]'], relayout['xaxis.range[1]']]
+    elif 'xaxis.range' in relayout:
+        x = relayout['xaxis.range'][:2]
+    elif relayout.get('xaxis.autorange'):
+        x = None
+    else:
+        return zoom
+    return json.dumps(dict(x=x, inputs=inputs))
+
+def zoomed_years(zoom, inputs):
+    '''
+    The years shown: those the plot is zoomed in on, within the years
+    selected on the slider. A zoom made before the word, facet, values or
+    years last changed no longer applies: the plot is redrawn zoomed out.
+    '''
+    min_year, max_year = inputs[-1]
+    try:
+        zoom = json.loads(zoom)
+        x0, x1 = zoom['x']
+    except (TypeError, ValueError, KeyError):
+        return min_year, max_year
+    if zoom['inputs'] != inputs:
+        return min_year, max_year
+    lo = max(min_year, int(math.ceil(min(x0, x1))))
+    hi = min(max_year, int(math.floor(max(x0, x1))))
+    if lo > hi:
+        return min_year, max_year
+    return lo, hi
+
+def heatmap_view(word, facet, facet_query, years, zoom, stale=False):
+    '''
+    The full resolution block of the heatmap that is on screen, and the bin
+    width it is shown at. With `stale`, only the last known cached data is
+    used.
+    '''
+    get_matrix = get_stale_heatmap_matrix if stale else get_heatmap_matrix
+    m = get_matrix(word, facet, max_facet_values, log=True, smoothing=5)
+    min_year, max_year = zoomed_years(zoom, heatmap_inputs(word, facet, facet_query, years))
+    block = m.select(facet_query, min_year, max_year)
+    return block, level_of_detail(len(block.labels), min_year, max_year)
+
+@metrics.timed('figure')
+def heatmap_figure(m, word, facet, width=1):
+    '''
+    Plot data and layout for a selected block of a heatmap matrix, with
+    years averaged into bins `width` wide.
+    '''
+    xaxis = {}
+    if width > 1:
+        m = m.bin_columns(width)
+        xaxis = dict(title='%d-year averages (zoom in for single years)' % width)
+    # Centre each bin on the years it covers
+    data = [go.Heatmap(z=m.values,
+                   x=m.columns + (width - 1) / 2.,
+                   y=m.labels,
                    showscale=False
                   )
        ]
     
     layout = go.Layout(
-        title='"%s" by %s' % (word, pretty_facet(facet))
+        title='"%s" by %s' % (word, pretty_facet(facet)),
+        xaxis=xaxis
     )
 
     return (data, layout)
 
 #df = get_heatmap_values('cookie', 'class', 15)
-#plotdata, layout = format_heatmap_data(df, 'cookie', True, 10, 1900, 2000)
+#plotdata, layout = format_heatmap_data(df, 'cookie', True, 5, 1900, 2000)
 
 app.layout = html.Div([
      html.Div([
@@ -103,8 +221,8 @@ app.layout = html.Div([
             
                 html.Div(
                     [html.Div(html.Label("Search For a Term: ")),
-                     html.Div(dcc.Input(id='search-term', type='text', value='computer')),
-                     dcc.Input(id='search-term-hidden', type='hidden', value=json.dumps(dict(word='computer', compare=''))),
+                     html.Div(dcc.Input(id='search-term', type='text', value=default_word)),
+                     dcc.Input(id='search-term-hidden', type='hidden', value=json.dumps(dict(word=default_word, compare=''))),
                      html.Small("Combine search words with a comma. Only single word queries supported."),
                      ],
                 ),
@@ -118,7 +236,7 @@ app.layout = html.Div([
                 ),
                 html.Div(
                     [html.Label("Facet by:"),
-                     dcc.Dropdown(id='group-dropdown', options=facet_opts, value='class')
+                     dcc.Dropdown(id='group-dropdown', options=facet_opts, value=default_facet)
                     ]
                 ),
                 html.Div(
@@ -147,7 +265,11 @@ app.layout = html.Div([
             ],
             className='col-md-3'),
         html.Div(
-            [dcc.Graph(id='main-heatmap-graph', animate=False, config=graphconfig)],
+            [dcc.Graph(id='main-heatmap-graph', animate=False, config=graphconfig),
+             # The zoom on the plot (see zoom_after)
+             dcc.Input(id='heatmap-zoom', type='hidden', value=''),
+             # Polls for the heatmap while a job fetches it (see jobs.py)
+             dcc.Interval(id='heatmap-poll', interval=jobs.poll(None))],
             className='col-md-9')
     ], className='row'),
       html.Div([
@@ -156,6 +278,7 @@ app.layout = html.Div([
             Choose a place on the heatmap to see matching books.
             """),
             html.Div(id='heatmap-select-data'),
+            html.Button('Load more', id='heatmap-select-data-more', className='btn btn-default btn-sm'),
         ], className='col-md-offset-4 col-md-8')
       ], className='row')
     ], className='container-fluid')
@@ -171,7 +294,7 @@ def set_facet_value_options(facet):
             return w[:n]+'…'
         else:
             return w
-    return [{'label': trim(x), 'value': x} for x in bw_heatmap.field_values(facet, 40) if x.strip() != '']
+    return [{'label': trim(x), 'value': x} for x in facets.store.values(facet, max_facet_values) if x.strip() != '']
 
 @app.callback(
     Output("facet-values", "value"),
@@ -180,39 +303,44 @@ def set_facet_value_options(facet):
 def set_facet_value_defaults(options):
     return [option['value'] for option in options[:10]]
     
+@app.callback(
+    Output('heatmap-select-data-more', 'n_clicks'),
+    [Input('main-heatmap-graph', 'clickData')]
+)
+def reset_click_data_pages(clickData):
+    return 0
+
+# A new click goes back to the first page, which in turn lists the books, so
+# the list only needs to listen to the "Load more" button.
 @app.callback(
     Output('heatmap-select-data', 'children'),
-    [Input('main-heatmap-graph', 'clickData')],
-    state=[State('search-term-hidden', 'value'),
-           State('group-dropdown', 'value')])
-def display_click_data(clickData, word_query, facet):
-    import re
+    [Input('heatmap-select-data-more', 'n_clicks')],
+    state=[State('main-heatmap-graph', 'clickData'), State('search-term-hidden', 'value'),
+           State('group-dropdown', 'value'), State("facet-values", "value"),
+           State('year-slider', "value"), State('heatmap-zoom', 'value')])
+def display_click_data(n_clicks, clickData, word_query, facet, facet_query, years, zoom):
     word_query=json.loads(word_query)
     word = word_query['word']
     compare_word = word_query['compare']
     try:
         facet_value_select = clickData['points'][0]['y']
-        year_select = int(clickData['points'][0]['x'])
+        x = float(clickData['points'][0]['x'])
     except:
         return html.Ul(html.Li(html.Em("Nothing selected")))
+    # A click on a binned cell covers every year in its bin
+    min_year, max_year = zoomed_years(zoom, heatmap_inputs(word, facet, facet_query, years))
+    width = level_of_detail(visible_rows(word, facet, facet_query), min_year, max_year)
+    start = (int(math.floor(x)) // width) * width
+    if width > 1:
+        year_select = {'$gte': max(start, min_year), '$lte': min(start + width - 1, max_year)}
+    else:
+        year_select = int(round(x))
     if compare_word and compare_word.strip() != '':
         word = word + "," + compare_word
     q = word.split(",")
-        
-    bw_html.search_limits = { facet: [facet_value_select], 'date_year':year_select, 'word': q }
-    results = bw_html.run()
-    
-    # Format results
-    links = []
-    for result in results.json():
-        try:
-            groups = re.search("href=(.*)><em>(.*?)</em> \((.*?)\)", result).groups()
-            link = html.Li(html.A(href=groups[0], target='_blank', children=["%s (%s)" % (groups[1], groups[2])]))
-            links.append(link)
-        except:
-            raise
-    print(links)
-    return html.Ul(links)
+
+    return examples.book_list({ facet: [facet_value_select], 'date_year': year_select }, q,
+                              pages=(n_clicks or 0) + 1)
 
 @app.callback(
     Output('year-display', 'children'),
@@ -229,30 +357,63 @@ def display_year(years):
 def update_hidden_search_term(n_clicks, word, compare):
     return json.dumps(dict(word=word, compare=compare))
 
+if jobs.enabled:
+    @app.callback(
+        Output('heatmap-poll', 'interval'),
+        [Input('main-heatmap-graph', 'figure')]
+    )
+    def poll_while_loading(figure):
+        return jobs.poll(figure)
+
+@app.callback(
+    Output('heatmap-zoom', 'value'),
+    [Input('main-heatmap-graph', 'relayoutData')],
+    state=[State('heatmap-zoom', 'value'), State('search-term-hidden', 'value'),
+           State('group-dropdown', 'value'), State("facet-values", "value"),
+           State('year-slider', "value")])
+def set_zoom(relayout, zoom, word_query, facet, facet_query, years):
+    word = json.loads(word_query)['word']
+    return zoom_after(relayout, zoom, heatmap_inputs(word, facet, facet_query, years))
+
 @app.callback(
     Output('main-heatmap-graph', 'figure'),
     [Input('search-term-hidden', 'value'),
            Input('group-dropdown', 'value'), Input("facet-values", "value"),
-           Input('year-slider', "value")]
+           Input('year-slider', "value"), Input('heatmap-zoom', 'value')],
+    events=[Event('heatmap-poll', 'interval')] if jobs.enabled else []
 )
-def heatmap_search(word_query, facet, facet_query, years):
+def heatmap_search(word_query, facet, facet_query, years, zoom):
     try:
         word_query=json.loads(word_query)
         word = word_query['word']
-        compare_word = word_query['compare']
-        max_facet_values = 30
-
-        # Display params
-        log = True
-        smoothing = 10
-        df = get_heatmap_values(word, facet, max_facet_values,
-                                hard_min_year=hard_min_year, hard_max_year=hard_max_year)
-        # Important, break reference to cached version
-        df = df.copy()
-        if not facet_query:
-            facet_query = []
-        plotdata, layout = format_heatmap_data(df, word, log, smoothing, years[0], years[1], tuple(facet_query))
-        fig = dict( data=plotdata, layout=layout )
+
+        # None, or why the last known heatmap is shown instead
+        status = None
+        try:
+            if not jobs.enabled:
+                block, width = within_deadline(heatmap_view, word, facet, facet_query, years, zoom)
+            elif jobs.queue.ready(get_heatmap_values, word, facet, max_facet_values,
+                                  hard_min_year=hard_min_year, hard_max_year=hard_max_year):
+                block, width = heatmap_view(word, facet, facet_query, years, zoom)
+            else:
+                # A job is fetching it; the page polls until it is done
+                status = jobs.pending_note
+        except Exception:
+            # Too slow or failed: show the last known heatmap. A slow fetch
+            # carries on in the background and refreshes the cache.
+            logging.warning("Heatmap for %r not ready in time, using cached data", word_query, exc_info=True)
+            status = 'stale'
+        if status is not None:
+            try:
+                block, width = heatmap_view(word, facet, facet_query, years, zoom, stale=True)
+            except KeyError:
+                if status != jobs.pending_note:
+                    raise
+                return jobs.placeholder('"%s" by %s' % (word, pretty_facet(facet)))
+        plotdata, layout = heatmap_figure(block, word, facet, width)
+        if status is not None:
+            layout['title'] += ' (%s)' % status
+        fig = figures.compact(dict( data=plotdata, layout=layout ))
     except:
         logging.exception(json.dumps(dict(page='heatmap', word_query=word_query, facet=facet,
                                       facet_query=facet_query, years=years)))
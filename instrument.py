@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+'''
+Latency instrumentation for every Dash callback, and a metrics endpoint.
+
+instrument(app) must run before any callback is registered. From then on,
+each call of a callback is traced: its total time, the time in each phase
+marked with metrics.phase/timed (query, frame, transform, figure, encode), the rest
+of the callback's own time ('other'), JSON serialization and the response
+size. Prometheus text is served at <url_base_pathname>metrics.
+
+Profiling, off by default:
+
+    BW_PROFILE_SLOW  profile every callback and dump the cProfile stats of
+                     those slower than this many seconds
+    BW_PROFILE_DIR   where stats are dumped (default: profiles)
+
+A single request can also be profiled by sending an `X-Profile: 1` header.
+Work the callback hands to other threads through bookworm.submit or
+within_deadline is profiled too, and its stats are added to the callback's,
+as long as it is done by the time the callback returns.
+'''
+import os
+import time
+import cProfile
+import pstats
+import logging
+import flask
+import metrics
+import bookworm
+import cache
+
+profile_slow = os.environ.get('BW_PROFILE_SLOW')
+profile_slow = float(profile_slow) if profile_slow else None
+profile_dir = os.environ.get('BW_PROFILE_DIR', 'profiles')
+
+def _own_time(func):
+    # Time spent in the callback function itself, before Dash serializes
+    # its output
+    def wrapper(*args, **kwargs):
+        trace = metrics.current_trace()
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if trace is not None:
+                trace.own = time.time() - start
+    return wrapper
+
+def _dump_profile(profiler, trace, name, elapsed):
+    os.makedirs(profile_dir, exist_ok=True)
+    fname = os.path.join(profile_dir, "%s-%d-%dms.prof" % (name, time.time() * 1000, elapsed * 1000))
+    stats = pstats.Stats(profiler)
+    for other in trace.bound_profiles():
+        stats.add(other)
+    stats.dump_stats(fname)
+    logging.warning("Callback %s took %.3fs; profile saved to %s", name, elapsed, fname)
+
+def _served(func, name):
+    def wrapper(*args, **kwargs):
+        forced = flask.has_request_context() and flask.request.headers.get('X-Profile') == '1'
+        profiler = cProfile.Profile() if (forced or profile_slow is not None) else None
+        with metrics.tracing() as trace:
+            if profiler is not None:
+                trace.profiles = []
+            start = time.time()
+            try:
+                if profiler is not None:
+                    response = profiler.runcall(func, *args, **kwargs)
+                else:
+                    response = func(*args, **kwargs)
+            except Exception:
+                metrics.counter('bookworm_callback_errors_total', callback=name).inc()
+                raise
+            finally:
+                elapsed = time.time() - start
+        metrics.histogram('bookworm_callback_seconds', callback=name).observe(elapsed)
+        own = trace.own if trace.own is not None else elapsed
+        phases = dict(trace.phases)
+        phases['other'] = max(own - sum(phases.values()), 0)
+        phases['serialize'] = max(elapsed - own, 0)
+        for phase, seconds in phases.items():
+            metrics.histogram('bookworm_callback_phase_seconds', callback=name, phase=phase).observe(seconds)
+        metrics.histogram('bookworm_callback_response_bytes', metrics.size_buckets,
+                          callback=name).observe(len(response.get_data()))
+        if profiler is not None and (forced or elapsed > profile_slow):
+            _dump_profile(profiler, trace, name, elapsed)
+        return response
+    return wrapper
+
+def serve_metrics():
+    extra = [('bookworm_queries_coalesced', {}, bookworm.inflight.coalesced)]
+    for namespace, counts in cache.get_cache().stats().items():
+        for outcome, value in counts.items():
+            extra.append(('bookworm_cache_' + outcome, {'namespace': namespace}, value))
+    return flask.Response(metrics.render(extra), mimetype='text/plain; version=0.0.4')
+
+def instrument(app):
+    ''' Trace every callback registered on app from now on, and serve metrics. '''
+    register_callback = app.callback
+
+    def callback(output, inputs=[], state=[], events=[]):
+        register = register_callback(output, inputs, state, events)
+        name = '%s.%s' % (output.component_id, output.component_property)
+
+        def wrap_func(func):
+            registered = _served(register(_own_time(func)), name)
+            app.callback_map[name]['callback'] = registered
+            return registered
+        return wrap_func
+    app.callback = callback
+
+    app.server.add_url_rule(app.url_base_pathname + 'metrics', 'metrics', serve_metrics)
+    return app
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+'''
+Slow queries as background jobs, so that callbacks answer at once.
+
+With BW_JOBS=1, a callback whose data isn't cached hands the fetch to a job,
+and if the job isn't done within BW_JOBS_WAIT seconds it answers with what
+it has: the last known figure, or a placeholder, marked as loading. While a
+loading figure is shown, a dcc.Interval on the page polls every
+BW_JOBS_POLL seconds, and the callback swaps in the real figure once the job
+is done. A web worker thread is only held for the wait, so it stays free
+for fast requests.
+
+A job is keyed by the result cache key of the call it makes. Identical
+requests share one job, in this process and, through a lease in the
+warmer's database, across the workers on a machine. The result goes into
+the shared result cache, so whichever worker a poll reaches can serve it.
+Jobs run on a bounded pool. Polling stops when the user asks for something
+else, and a job nobody has polled for BW_JOBS_ABANDON seconds is cancelled
+if it hasn't started yet.
+
+    BW_JOBS          set to 1 to run slow callbacks as jobs (default: off)
+    BW_JOBS_THREADS  jobs run at once in each process (default: 4)
+    BW_JOBS_WAIT     seconds a callback waits for its job (default: 0.5)
+    BW_JOBS_POLL     seconds between polls from the page (default: 1)
+    BW_JOBS_ABANDON  seconds without a poll before a queued job is
+                     cancelled (default: 15)
+    BW_JOBS_LEASE    seconds before another worker may run a job that
+                     hasn't finished (default: 120)
+'''
+import os
+import time
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, CancelledError
+import metrics
+import cache
+import warmer
+
+enabled = os.environ.get('BW_JOBS', '0') == '1'
+poll_interval = float(os.environ.get('BW_JOBS_POLL', 1))
+# dcc.Interval only picks up a change of `interval`, not of `disabled`, so
+# polling is turned off by making the interval a day long
+idle_interval = 24 * 3600
+
+pending_note = 'loading'
+
+class Job(object):
+
+    def __init__(self, key, future):
+        self.key = key
+        self.future = future
+        self.polled = time.time()
+
+class JobQueue(object):
+    ''' Deduplicated jobs that fetch the values of cached functions. '''
+
+    def __init__(self, threads=4, wait=0.5, abandon=15, lease=120, leases=None):
+        self.threads = threads
+        self.wait = wait
+        self.abandon = abandon
+        self.lease = lease
+        # Anything with claim(name, seconds) and release(name)
+        self.leases = leases
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._executor = None
+        self._pid = None
+
+    def _pool(self):
+        # Threads don't survive a fork, so a new process gets a new pool
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.threads)
+            self._pid = os.getpid()
+            self._jobs = {}
+        return self._executor
+
+    def _release(self, key):
+        if self.leases is not None:
+            try:
+                self.leases.release('job:' + key)
+            except Exception:
+                logging.warning("Could not release the lease on job %s", key, exc_info=True)
+
+    def _run(self, key, func, args, kwargs):
+        try:
+            func(*args, **kwargs)
+        finally:
+            self._release(key)
+
+    def _submit(self, key, func, args, kwargs):
+        # The job for key, started if there is none. None if another
+        # process is running it.
+        with self._lock:
+            pool = self._pool()
+            job = self._jobs.get(key)
+            if job is not None:
+                metrics.counter('bookworm_jobs_total', outcome='shared').inc()
+                return job
+            if self.leases is not None and not self.leases.claim('job:' + key, self.lease):
+                metrics.counter('bookworm_jobs_total', outcome='elsewhere').inc()
+                return None
+            job = self._jobs[key] = Job(key, pool.submit(self._run, key, func, args, kwargs))
+            metrics.counter('bookworm_jobs_total', outcome='submitted').inc()
+            return job
+
+    def _forget(self, job):
+        with self._lock:
+            if self._jobs.get(job.key) is job:
+                del self._jobs[job.key]
+
+    def ready(self, func, *args, **kwargs):
+        '''
+        Whether the value of a cached function for these arguments can be
+        served now, fresh or stale. If it can't, a job is started (or joined) to
+        fetch it, and waited on for a moment. Raises the job's exception if
+        it failed.
+        '''
+        self.reap()
+        key = cache.get_cache().make_key(func.namespace, args, kwargs)
+        with self._lock:
+            job = self._jobs.get(key)
+        if job is None:
+            # A stale value is served too, and refreshed in the background
+            if func.is_servable(*args, **kwargs):
+                return True
+            job = self._submit(key, func, args, kwargs)
+            if job is None:
+                # Its result will reach the shared cache
+                return False
+        job.polled = time.time()
+        try:
+            job.future.result(timeout=self.wait)
+        except TimeoutError:
+            return False
+        except CancelledError:
+            self._forget(job)
+            return False
+        except Exception:
+            self._forget(job)
+            metrics.counter('bookworm_jobs_total', outcome='failed').inc()
+            raise
+        self._forget(job)
+        return True
+
+    def cancel(self, key):
+        ''' Cancel a job that hasn't started. Returns whether it was cancelled. '''
+        with self._lock:
+            job = self._jobs.get(key)
+        if job is None or not job.future.cancel():
+            return False
+        self._forget(job)
+        self._release(key)
+        metrics.counter('bookworm_jobs_total', outcome='cancelled').inc()
+        return True
+
+    def reap(self):
+        ''' Cancel queued jobs nobody is polling, and drop finished ones nobody collected. '''
+        now = time.time()
+        with self._lock:
+            abandoned = [job for job in self._jobs.values() if now - job.polled > self.abandon]
+        for job in abandoned:
+            if not self.cancel(job.key) and job.future.done():
+                self._forget(job)
+
+queue = JobQueue(threads=int(os.environ.get('BW_JOBS_THREADS', 4)),
+                 wait=float(os.environ.get('BW_JOBS_WAIT', 0.5)),
+                 abandon=float(os.environ.get('BW_JOBS_ABANDON', 15)),
+                 lease=float(os.environ.get('BW_JOBS_LEASE', 120)),
+                 leases=warmer.popularity)
+
+def placeholder(title):
+    ''' An empty, loading figure to show until a job is done. '''
+    return dict(data=[], layout=dict(
+        title='%s (%s)' % (title, pending_note),
+        xaxis=dict(visible=False), yaxis=dict(visible=False),
+        annotations=[dict(text='Fetching the data; this can take a while for rare words and large facets',
+                          showarrow=False, xref='paper', yref='paper', x=0.5, y=0.5)]))
+
+def is_pending(figure):
+    ''' Whether a figure is marked as loading. '''
+    try:
+        return figure['layout']['title'].endswith('(%s)' % pending_note)
+    except (TypeError, KeyError, AttributeError):
+        return False
+
+def poll(figure):
+    ''' The interval, in ms, at which a page showing `figure` should poll. '''
+    return int((poll_interval if is_pending(figure) else idle_interval) * 1000)
@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+'''
+Replay user sessions against the app and report latency per callback.
+
+Each session loads a page and then does what a visitor would: on the map,
+types terms, presses Update, switches scope and clicks places; on the
+heatmap, drags the year slider, zooms, searches and clicks cells; on the
+bar chart, changes the facet and trim, hovers over bars and pages through
+the table. Sessions post to `_dash-update-component` exactly as the
+renderer does, and later steps use what earlier responses returned (a
+click lands on a point that is actually on the map). Search terms are drawn
+from a skewed vocabulary, so some repeat and some don't.
+
+By default the app is served in this process, against a synthetic Bookworm
+stand-in (see standin.py) with its own scratch cache:
+
+    python loadtest.py --sessions 200 --concurrency 16 --latency 0.2
+
+To compare worker and thread configurations, run the app under gunicorn
+against a stand-in and point the load test at it:
+
+    python standin.py synthetic --port 8081 --facets 200 --latency 0.2
+    BOOKWORM_ENDPOINT=http://localhost:8081/cgi-bin/dbbindings.py \\
+        gunicorn -c gunicorn.conf.py --workers 4 --threads 8 app:server
+    python loadtest.py --url http://localhost:8000/app/ --sessions 500 --concurrency 32
+
+The report gives throughput and, per callback, p50/p95/p99 latency and the
+rate of errors: HTTP failures, and callbacks that answered with the error
+figure. Figures served stale after missing the callback deadline, and
+loading figures answered while a job fetches the data (see jobs.py), are
+counted separately; sessions poll loading figures every --poll seconds
+like the page does. --json saves the report.
+'''
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import logging
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import requests
+
+# Search terms, most popular first; sessions draw from them with Zipf weights
+vocabulary = ['computer', 'color', 'colour', 'railway', 'telegraph', 'steam', 'electricity',
+              'radio', 'science', 'democracy', 'slavery', 'cholera', 'whale', 'telephone',
+              'automobile', 'socialism', 'photograph', 'aeroplane', 'vaccine', 'television',
+              'cinema', 'atom', 'evolution', 'empire', 'famine', 'typewriter', 'bicycle',
+              'phonograph', 'submarine', 'penicillin']
+weights = [1. / rank for rank in range(1, len(vocabulary) + 1)]
+
+facet_groups = ['class', 'language', 'publication_country', 'literary_form', 'subclass']
+
+# Page defaults, as in map.py, heatmap.py and bar_chart.py
+map_defaults = dict(word='color', compare='colour', type='scattergeo', scope='country')
+heatmap_defaults = dict(word='computer', facet='class', years=[1900, 2000], hard_years=(1650, 2015))
+bar_defaults = dict(group='language', trim=20, drop='drop', counttype='TextCount')
+
+error_text = 'There was an error!'
+
+class Recorder(object):
+    ''' Latency and outcome of every callback request. '''
+
+    outcomes = ['ok', 'stale', 'loading', 'error_figure', 'http_error', 'failed']
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = {}
+        self.sessions = 0
+        self.started = None
+        self.finished = None
+
+    def add(self, callback, seconds, outcome, size):
+        with self._lock:
+            self.calls.setdefault(callback, []).append((seconds, outcome, size))
+
+    def session_done(self):
+        with self._lock:
+            self.sessions += 1
+
+    def report(self):
+        elapsed = (self.finished or time.time()) - self.started
+        total = sum(len(calls) for calls in self.calls.values())
+        report = {'seconds': elapsed, 'sessions': self.sessions, 'requests': total,
+                  'requests_per_second': total / elapsed if elapsed else 0,
+                  'sessions_per_second': self.sessions / elapsed if elapsed else 0,
+                  'callbacks': {}}
+        for callback, calls in sorted(self.calls.items()):
+            seconds = np.array([s for s, _, _ in calls])
+            counts = {outcome: 0 for outcome in self.outcomes}
+            for _, outcome, _ in calls:
+                counts[outcome] += 1
+            errors = counts['error_figure'] + counts['http_error'] + counts['failed']
+            p50, p95, p99 = np.percentile(seconds, [50, 95, 99])
+            report['callbacks'][callback] = {
+                'requests': len(calls), 'p50': p50, 'p95': p95, 'p99': p99,
+                'mean': seconds.mean(), 'max': seconds.max(),
+                'error_rate': errors / float(len(calls)),
+                'stale_rate': counts['stale'] / float(len(calls)),
+                'loading_rate': counts['loading'] / float(len(calls)),
+                'outcomes': counts,
+                'mean_bytes': int(np.mean([size for _, _, size in calls]))}
+        return report
+
+def _outcome(value):
+    # Callbacks catch their own exceptions and answer with errorfig or a
+    # "(stale)" or "(loading)" title, so look at the figure as well as the
+    # status
+    if isinstance(value, dict) and 'layout' in value:
+        layout = value.get('layout') or {}
+        for annotation in layout.get('annotations') or []:
+            if error_text in str(annotation.get('text', '')):
+                return 'error_figure'
+        for outcome in ['stale', 'loading']:
+            if str(layout.get('title', '')).endswith('(%s)' % outcome):
+                return outcome
+    return 'ok'
+
+class Session(object):
+    ''' One visitor: a connection and their page's component values. '''
+
+    def __init__(self, url, recorder, rng, think=0, timeout=60, poll=1, max_polls=60):
+        self.url = url.rstrip('/') + '/'
+        self.recorder = recorder
+        self.rng = rng
+        self.think = think
+        self.timeout = timeout
+        self.poll = poll
+        self.max_polls = max_polls
+        self.http = requests.Session()
+        self.values = {}
+
+    def pause(self):
+        if self.think:
+            time.sleep(self.rng.uniform(0, self.think))
+
+    def word(self):
+        return self.rng.choices(vocabulary, weights)[0]
+
+    def call(self, output, inputs=(), state=()):
+        '''
+        Fire the callback for `output` ("id.property") with the current
+        values of its inputs and state, like the renderer. The new value
+        is stored and returned, or None if the request failed.
+        '''
+        def props(names):
+            return [{'id': name.split('.')[0], 'property': name.split('.')[1],
+                     'value': self.values.get(name)} for name in names]
+        payload = {'output': {'id': output.split('.')[0], 'property': output.split('.')[1]},
+                   'inputs': props(inputs), 'state': props(state)}
+        start = time.time()
+        try:
+            r = self.http.post(self.url + '_dash-update-component', json=payload, timeout=self.timeout)
+        except requests.RequestException:
+            self.recorder.add(output, time.time() - start, 'failed', 0)
+            return None
+        elapsed = time.time() - start
+        if r.status_code != 200:
+            self.recorder.add(output, elapsed, 'http_error', len(r.content))
+            return None
+        try:
+            value = r.json()['response']['props'][output.split('.')[1]]
+        except (ValueError, KeyError, TypeError):
+            self.recorder.add(output, elapsed, 'failed', len(r.content))
+            return None
+        self.recorder.add(output, elapsed, _outcome(value), len(r.content))
+        self.values[output] = value
+        return value
+
+    def draw(self, output, inputs=(), state=()):
+        ''' Call, and poll again while the answer is a loading figure. '''
+        value = self.call(output, inputs, state)
+        for _ in range(self.max_polls):
+            if _outcome(value) != 'loading':
+                break
+            time.sleep(self.poll)
+            value = self.call(output, inputs, state)
+        return value
+
+    def open(self, page):
+        self.values['url.pathname'] = urlparse(self.url).path + page
+        self.call('page-content.children', ['url.pathname'])
+
+def map_session(s):
+    d = map_defaults
+    s.open('map')
+    s.values.update({'search-term.value': d['word'], 'compare-term.value': d['compare'],
+                     'map_type.value': d['type'], 'map_scope.value': d['scope'],
+                     'map-search-term-hidden.value': json.dumps(dict(word=d['word'], compare=d['compare']))})
+    draw = ['map-search-term-hidden.value', 'map_type.value', 'map_scope.value']
+    s.call('main-map-graph.figure', draw)
+
+    for _ in range(s.rng.randint(1, 3)):
+        s.pause()
+        # Type a term, maybe a comparison, and press Update
+        s.values['search-term.value'] = s.word()
+        s.values['compare-term.value'] = s.word() if s.rng.random() < 0.5 else ''
+        s.call('map-search-term-hidden.value', state=['search-term.value', 'compare-term.value'])
+        figure = s.call('main-map-graph.figure', draw)
+        if s.rng.random() < 0.3:
+            s.pause()
+            s.values['map_type.value'] = s.rng.choice(['scattergeo', 'choropleth'])
+            figure = s.call('main-map-graph.figure', draw)
+        if s.rng.random() < 0.3:
+            s.pause()
+            s.values['map_scope.value'] = s.rng.choice(['country', 'state'])
+            figure = s.call('main-map-graph.figure', draw)
+        _click_map(s, figure)
+
+def _click_map(s, figure):
+    try:
+        texts = [t for trace in figure['data'] for t in trace['text']]
+    except (TypeError, KeyError):
+        return
+    if not texts:
+        return
+    s.pause()
+    s.values['main-map-graph.clickData'] = {'points': [{'text': s.rng.choice(texts)}]}
+    s.call('select-data-more.n_clicks', ['main-map-graph.clickData'])
+    listing = ['main-map-graph.clickData', 'search-term.value', 'compare-term.value', 'map_scope.value']
+    s.call('select-data.children', ['select-data-more.n_clicks'], listing)
+    if s.rng.random() < 0.3:
+        s.pause()
+        s.values['select-data-more.n_clicks'] += 1
+        s.call('select-data.children', ['select-data-more.n_clicks'], listing)
+
+def heatmap_session(s):
+    d = heatmap_defaults
+    s.open('heatmap')
+    s.values.update({'search-term.value': d['word'], 'compare-term.value': 'colour',
+                     'search-term-hidden.value': json.dumps(dict(word=d['word'], compare='')),
+                     'group-dropdown.value': d['facet'], 'year-slider.value': list(d['years']),
+                     'main-heatmap-graph.relayoutData': None, 'heatmap-zoom.value': ''})
+    draw = ['search-term-hidden.value', 'group-dropdown.value', 'facet-values.value',
+            'year-slider.value', 'heatmap-zoom.value']
+    s.call('year-display.children', ['year-slider.value'])
+    s.call('facet-values.options', ['group-dropdown.value'])
+    s.call('facet-values.value', ['facet-values.options'])
+    figure = s.draw('main-heatmap-graph.figure', draw)
+
+    for _ in range(s.rng.randint(1, 4)):
+        s.pause()
+        action = s.rng.random()
+        if action < 0.4:
+            # Drag one end of the year slider
+            lo, hi = s.values['year-slider.value']
+            hard_lo, hard_hi = d['hard_years']
+            if s.rng.random() < 0.5:
+                lo = s.rng.randint(hard_lo, hi - 10)
+            else:
+                hi = s.rng.randint(lo + 10, hard_hi)
+            s.values['year-slider.value'] = [lo, hi]
+            s.call('year-display.children', ['year-slider.value'])
+        elif action < 0.6:
+            # Zoom in on part of the plot
+            lo, hi = s.values['year-slider.value']
+            start = s.rng.randint(lo, hi - 5)
+            s.values['main-heatmap-graph.relayoutData'] = {
+                'xaxis.range[0]': start, 'xaxis.range[1]': s.rng.randint(start + 5, hi)}
+            s.call('heatmap-zoom.value', ['main-heatmap-graph.relayoutData'],
+                   ['heatmap-zoom.value', 'search-term-hidden.value', 'group-dropdown.value',
+                    'facet-values.value', 'year-slider.value'])
+        elif action < 0.8:
+            s.values['search-term.value'] = s.word()
+            s.values['word_search_button.n_clicks'] = (s.values.get('word_search_button.n_clicks') or 0) + 1
+            s.call('search-term-hidden.value', ['word_search_button.n_clicks'],
+                   ['search-term.value', 'compare-term.value'])
+        else:
+            s.values['group-dropdown.value'] = s.rng.choice(facet_groups)
+            s.call('facet-values.options', ['group-dropdown.value'])
+            s.call('facet-values.value', ['facet-values.options'])
+        figure = s.draw('main-heatmap-graph.figure', draw) or figure
+        _click_heatmap(s, figure)
+
+def _click_heatmap(s, figure):
+    try:
+        trace = figure['data'][0]
+        x, y = s.rng.choice(trace['x']), s.rng.choice(trace['y'])
+    except (TypeError, KeyError, IndexError):
+        return
+    if s.rng.random() < 0.5:
+        return
+    s.pause()
+    s.values['main-heatmap-graph.clickData'] = {'points': [{'x': x, 'y': y}]}
+    s.call('heatmap-select-data-more.n_clicks', ['main-heatmap-graph.clickData'])
+    s.call('heatmap-select-data.children', ['heatmap-select-data-more.n_clicks'],
+           ['main-heatmap-graph.clickData', 'search-term-hidden.value', 'group-dropdown.value',
+            'facet-values.value', 'year-slider.value', 'heatmap-zoom.value'])
+
+def bar_session(s):
+    d = bar_defaults
+    s.open('bar')
+    s.values.update({'group-dropdown.value': d['group'], 'trim-slider.value': d['trim'],
+                     'drop-radio.value': d['drop'], 'counttype-dropdown.value': d['counttype'],
+                     'table-sort.value': 'TextCount', 'table-order.value': 'desc',
+                     'bar-chart-main-graph.hoverData': None})
+    draw = ['group-dropdown.value', 'trim-slider.value', 'drop-radio.value', 'counttype-dropdown.value']
+    table = ['group-dropdown.value', 'drop-radio.value', 'table-sort.value', 'table-order.value']
+    hover = ['bar-chart-main-graph.hoverData', 'group-dropdown.value']
+    figure = s.call('bar-chart-main-graph.figure', draw)
+    s.call('table-page.value', table)
+    s.call('bar-data-table.children', ['table-page.value'], table)
+    s.call('date-distribution.figure', hover)
+
+    for _ in range(s.rng.randint(1, 4)):
+        s.pause()
+        action = s.rng.random()
+        if action < 0.5:
+            # Move along the bars; each one hovered redraws the distribution
+            try:
+                labels = figure['data'][0]['x']
+            except (TypeError, KeyError, IndexError):
+                labels = []
+            for label in s.rng.sample(labels, min(len(labels), s.rng.randint(1, 5))):
+                s.values['bar-chart-main-graph.hoverData'] = {'points': [{'x': label}]}
+                s.call('date-distribution.figure', hover)
+        elif action < 0.7:
+            s.values['table-page.value'] = (s.values.get('table-page.value') or 1) + 1
+            s.call('bar-data-table.children', ['table-page.value'], table)
+        elif action < 0.85:
+            s.values['trim-slider.value'] = s.rng.choice([10, 20, 30, 40, 50, 60])
+            figure = s.call('bar-chart-main-graph.figure', draw) or figure
+        else:
+            s.values['group-dropdown.value'] = s.rng.choice(facet_groups)
+            s.values['bar-chart-main-graph.hoverData'] = None
+            figure = s.call('bar-chart-main-graph.figure', draw) or figure
+            s.call('table-page.value', table)
+            s.call('bar-data-table.children', ['table-page.value'], table)
+            s.call('date-distribution.figure', hover)
+
+scripts = {'map': map_session, 'heatmap': heatmap_session, 'bar': bar_session}
+
+def run(url, sessions=100, concurrency=8, pages=('map', 'heatmap', 'bar'), think=0, seed=0,
+        timeout=60, poll=1):
+    ''' Run `sessions` sessions, `concurrency` at a time. Returns the Recorder. '''
+    recorder = Recorder()
+
+    def one(i):
+        rng = random.Random(seed * 1000003 + i)
+        session = Session(url, recorder, rng, think=think, timeout=timeout, poll=poll)
+        try:
+            scripts[rng.choice(list(pages))](session)
+        except Exception:
+            logging.exception("Session %d failed", i)
+        recorder.session_done()
+
+    recorder.started = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(sessions)))
+    recorder.finished = time.time()
+    return recorder
+
+def serve_in_process(facets=50, latency=0, jitter=0):
+    '''
+    Serve the app from this process, against a synthetic stand-in, with a
+    scratch cache and metadata directory. Returns the app URL.
+    '''
+    import standin
+    standin.use_locally(facets, latency, jitter)
+
+    import app
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+    app.load_pages()
+    server = make_server('127.0.0.1', 0, app.server, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, name='app', daemon=True).start()
+    return 'http://127.0.0.1:%d%s' % (server.port, app.app.url_base_pathname)
+
+def print_report(report):
+    print("%d sessions, %d requests in %.1fs: %.1f requests/s, %.2f sessions/s" % (
+        report['sessions'], report['requests'], report['seconds'],
+        report['requests_per_second'], report['sessions_per_second']))
+    print("%-36s %8s %8s %8s %8s %7s %7s %7s" % ('callback', 'requests', 'p50 ms', 'p95 ms',
+                                               'p99 ms', 'errors', 'stale', 'loading'))
+    for callback, stats in report['callbacks'].items():
+        print("%-36s %8d %8.0f %8.0f %8.0f %6.1f%% %6.1f%% %6.1f%%" % (
+            callback, stats['requests'], stats['p50'] * 1000, stats['p95'] * 1000,
+            stats['p99'] * 1000, stats['error_rate'] * 100, stats['stale_rate'] * 100,
+            stats['loading_rate'] * 100))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay user sessions against the app.")
+    parser.add_argument('--url', help="App to test, e.g. http://localhost:8000/app/ "
+                                      "(default: serve it here, against a stand-in)")
+    parser.add_argument('--sessions', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8, help="Sessions at once")
+    parser.add_argument('--pages', nargs='*', choices=sorted(scripts), default=sorted(scripts))
+    parser.add_argument('--think', type=float, default=0,
+                        help="Up to this many seconds between a visitor's actions")
+    parser.add_argument('--timeout', type=float, default=60, help="Seconds to wait for a callback")
+    parser.add_argument('--poll', type=float, default=1,
+                        help="Seconds between polls for a loading figure (BW_JOBS_POLL)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--facets', type=int, default=50,
+                        help="Values per field in the stand-in (without --url)")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="Seconds added to each stand-in response (without --url)")
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--json', help="Save the report to this file")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    url = args.url or serve_in_process(args.facets, args.latency, args.jitter)
+    recorder = run(url, args.sessions, args.concurrency, args.pages, think=args.think,
+                   seed=args.seed, timeout=args.timeout, poll=args.poll)
+    report = recorder.report()
+    report['config'] = vars(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    failed = sum(stats['outcomes']['http_error'] + stats['outcomes']['failed']
+                 for stats in report['callbacks'].values())
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
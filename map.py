@@ -3,14 +3,19 @@ import dash
 import dash_core_components as dcc
 import dash_html_components as html
 from dash.dependencies import  State, Event, Input, Output
-import plotly
 import plotly.graph_objs as go
 import pandas as pd
-import functools
+import numpy as np
+from cache import cached
 from common import app
 from common import graphconfig
-import bwypy
+from bookworm import QuerySpec, run, submit, within_deadline
 import json
+import metrics
+import figures
+import examples
+import geocodes
+import warmer
 from tools import errorfig, logging_config
 import logging
 from logging.config import dictConfig
@@ -20,14 +25,8 @@ logger = logging.getLogger()
 
 app.config.supress_callback_exceptions=True
 
-bwypy.set_options(database='Bookworm2016', endpoint='https://bookworm.htrc.illinois.edu/cgi-bin/dbbindings.py')
-bw_map = bwypy.BWQuery(verify_fields=False)
-bw_map.counttype = ['WordsPerMillion']
-bw_map.json['words_collation'] = 'case_insensitive'
-
-bw_html = bwypy.BWQuery(verify_fields=False)
-bw_html.json['method'] = 'search_results'
-bw_html.json['words_collation'] = 'case_insensitive'
+# Base queries. Each call derives its own spec from these with replace()
+bw_map = QuerySpec(counttype=['WordsPerMillion'], words_collation='case_insensitive', kind='map')
 
 keys = ['word', 'compare_word', 'type', 'scope']
 defaults = ['color', 'colour', 'scattergeo', 'country']
@@ -45,59 +44,82 @@ See where a word occurs in the 15 million volume [HathiTrust](https://www.hathit
 Locations correspond to the places that volumes were published in.
 '''
 
-country_codes = pd.read_csv('data/country_codes.csv')
-state_codes = pd.read_csv('data/state_codes_us.csv')
-
-@functools.lru_cache(maxsize=32)
+@cached()
 def get_word_by_us_state(word):
     words = [token.strip() for token in word.split(',')]
-    bw_map.search_limits = { 'word':word.split(','), 'publication_country': 'USA' }
-    bw_map.groups = ['*publication_country', 'publication_state']
-    results = bw_map.run()
+    spec = bw_map.replace(search_limits={ 'word':words, 'publication_country': 'USA' },
+                          groups=['*publication_country', 'publication_state'])
+    results = run(spec)
     df = results.frame(index=False, drop_unknowns=True)
-    data = pd.merge(df, state_codes)
-    return data
+    return geocodes.with_codes(df, 'publication_state')
 
-@functools.lru_cache(maxsize=32)
+@cached()
 def get_word_by_country(word):
     words = [token.strip() for token in word.split(',')]
-    bw_map.search_limits = { 'word':words }
-    bw_map.groups = ['publication_country']
-    results = bw_map.run()
+    spec = bw_map.replace(search_limits={ 'word':words }, groups=['publication_country'])
+    results = run(spec)
     df = results.frame(index=False, drop_unknowns=True)
-    data = pd.merge(df, country_codes)
-    return data
+    return geocodes.with_codes(df, 'publication_country')
 
-def build_map(word, compare_word=None, type='scattergeo', scope='country'):
-    import pandas as pd
-    import numpy as np
+# The default map is always served from a warm cache
+for term in [q['word'], q['compare_word']]:
+    warmer.keep_warm(get_word_by_country if q['scope'] == 'country' else get_word_by_us_state, term)
 
-    transform = lambda x: np.log(1+x/maxval)
-    
-    if scope == 'country':
-        data = get_word_by_country(word).copy()
-        if compare_word:
-            data2 = get_word_by_country(compare_word).copy()
-        field = 'publication_country'
-        scope = 'world'
-        projection = 'Mercator'
-        locationmode = 'ISO-3'
-    elif scope == 'state':
-        data = get_word_by_us_state(word).copy()
-        if compare_word:
-            data2 = get_word_by_us_state(compare_word).copy()
-        field = 'publication_state'
-        scope = 'usa'
-        projection = 'albers usa'
-        locationmode = 'USA-states'
-    
-    if compare_word and (compare_word.strip() != ''):
+map_scopes = {
+    'country': dict(field='publication_country', scope='world',
+                    projection='Mercator', locationmode='ISO-3'),
+    'state': dict(field='publication_state', scope='usa',
+                  projection='albers usa', locationmode='USA-states')
+}
+
+def build_map(word, compare_word=None, type='scattergeo', scope='country', stale=False):
+    '''
+    Fetch the data for a map and build it. A comparison term is fetched in
+    parallel with the main one. If only one of the two queries fails, the
+    other is mapped alone and the title says what is missing. With `stale`,
+    only the last known cached data is used.
+    '''
+    fetch = get_word_by_country if scope == 'country' else get_word_by_us_state
+    if stale:
+        fetch = fetch.last_known
+    if not (compare_word and compare_word.strip() != ''):
+        return map_figure(fetch(word), None, word, None, type, scope)
+
+    futures = [submit(fetch, word), submit(fetch, compare_word)]
+    results = []
+    for term, future in zip([word, compare_word], futures):
+        try:
+            results.append(future.result())
+        except Exception:
+            logging.exception(json.dumps(dict(page='map', failed_term=term, scope=scope)))
+            results.append(None)
+    data, data2 = results
+    if data is None and data2 is None:
+        raise Exception("Both map queries failed")
+    elif data2 is None:
+        return map_figure(data, None, word, None, type, scope,
+                          note="'%s' could not be loaded" % compare_word)
+    elif data is None:
+        return map_figure(data2, None, compare_word, None, type, scope,
+                          note="'%s' could not be loaded" % word)
+    return map_figure(data, data2, word, compare_word, type, scope)
+
+@metrics.timed('figure')
+def map_figure(data, data2, word, compare_word=None, type='scattergeo', scope='country', note=None):
+    ''' Build the plot data and layout for fetched map data. '''
+    field = map_scopes[scope]['field']
+
+    if data2 is not None:
         sizemod = 45
-        data = pd.merge(data,data2, on=[field, 'code'])
+        # Pair the terms by place name as well as code, in case two
+        # spellings of a place both turn up
+        data = pd.merge(data, data2, on=[field, 'code'])
         if type == 'scattergeo':
             data = data[(data['WordsPerMillion_x'] != 0) & (data['WordsPerMillion_y'] != 0)]
-        maxval = data[['WordsPerMillion_x', 'WordsPerMillion_y']].max().max()
-        logcounts = sizemod*(data['WordsPerMillion_x'].apply(transform) - data['WordsPerMillion_y'].apply(transform))
+        x = data['WordsPerMillion_x'].values
+        y = data['WordsPerMillion_y'].values
+        maxval = max(x.max(), y.max()) if len(data) else 1
+        logcounts = sizemod*(np.log1p(x/maxval) - np.log1p(y/maxval))
         text = ( data[field]
                  + "<br> Words Per Million<br>    '{}': ".format(word) 
                  + data['WordsPerMillion_x'].round(1).astype(str) 
@@ -109,15 +131,18 @@ def build_map(word, compare_word=None, type='scattergeo', scope='country'):
         sizemod = 40
         if type == 'scattergeo':
             data = data[(data['WordsPerMillion'] != 0)]
-        counts = data['WordsPerMillion'].astype(int)
-        maxval = counts.max()
-        logcounts = sizemod*counts.apply(transform)
+        counts = data['WordsPerMillion'].values.astype(int)
+        maxval = counts.max() if len(counts) else 1
+        logcounts = sizemod*np.log1p(counts/float(maxval))
         text = data[field] + '<br> Words Per Million:' + data['WordsPerMillion'].round(2).astype('str')
         title = "\'%s\' in the HathiTrust" % word
-        
-    if compare_word:
-        counts2 = data2['WordsPerMillion'].astype(int)
-   
+    if note:
+        title += " (%s)" % note
+
+    locationmode = map_scopes[scope]['locationmode']
+    projection = map_scopes[scope]['projection']
+    scope = map_scopes[scope]['scope']
+
     plotdata = [ dict(
             type=type,
             hoverinfo = "location+text",
@@ -135,14 +160,14 @@ def build_map(word, compare_word=None, type='scattergeo', scope='country'):
         plotdata[0]['autocolorscale'] = False
         plotdata[0]['showscale'] = False
         plotdata[0]['zauto'] = False
-        plotdata[0]['zmax'] = logcounts.abs().max()
-        plotdata[0]['zmin'] = -logcounts.abs().max()
+        plotdata[0]['zmax'] = np.abs(logcounts).max() if len(logcounts) else 0
+        plotdata[0]['zmin'] = -plotdata[0]['zmax']
     elif type == 'scattergeo':
-        plotdata[0]['marker']['size'] = logcounts.abs()
+        plotdata[0]['marker']['size'] = np.abs(logcounts)
         plotdata[0]['marker']['color'] = logcounts
         plotdata[0]['marker']['cauto'] = False
-        plotdata[0]['marker']['cmax'] = logcounts.abs().max()
-        plotdata[0]['marker']['cmin'] = -logcounts.abs().max()
+        plotdata[0]['marker']['cmax'] = np.abs(logcounts).max() if len(logcounts) else 0
+        plotdata[0]['marker']['cmin'] = -plotdata[0]['marker']['cmax']
     
     layout = dict(
             title = title,
@@ -222,18 +247,26 @@ app.layout = html.Div([
             Choose a place on the map to see matching books from there. All search and compare words included in matches.
             """),
             html.Div(id='select-data'),
+            html.Button('Load more', id='select-data-more', className='btn btn-default btn-sm'),
         ], className='col-md-offset-4 col-md-8')
       ], className='row')
     ], className='container-fluid')
 
+@app.callback(
+    Output('select-data-more', 'n_clicks'),
+    [Input('main-map-graph', 'clickData')]
+)
+def reset_click_data_pages(clickData):
+    return 0
+
+# A new click goes back to the first page, which in turn lists the books, so
+# the list only needs to listen to the "Load more" button.
 @app.callback(
     Output('select-data', 'children'),
-    [Input('main-map-graph', 'clickData')],
-    state=[State('search-term', 'value'), State('compare-term', 'value'),
-           State('map_scope', 'value')])
-def display_click_data(clickData, word, compare_word, mapscope):
-    import json
-    import re
+    [Input('select-data-more', 'n_clicks')],
+    state=[State('main-map-graph', 'clickData'), State('search-term', 'value'),
+           State('compare-term', 'value'), State('map_scope', 'value')])
+def display_click_data(n_clicks, clickData, word, compare_word, mapscope):
     try:
         limit = clickData['points'][0]['text'].split('<br>')[0]
     except:
@@ -241,20 +274,8 @@ def display_click_data(clickData, word, compare_word, mapscope):
     if compare_word and compare_word.strip() != '':
         word = word + "," + compare_word
     q = word.split(",")
-        
-    bw_html.search_limits = { 'publication_' + mapscope : [limit], 'word': q }
-    results = bw_html.run()
-    
-    # Format results
-    links = []
-    for result in results.json():
-        try:
-            groups = re.search("href=(.*)><em>(.*?)</em> \((.*?)\)", result).groups()
-            link = html.Li(html.A(href=groups[0], target='_blank', children=["%s (%s)" % (groups[1], groups[2])]))
-            links.append(link)
-        except:
-            raise
-    return html.Ul(links)
+
+    return examples.book_list({ 'publication_' + mapscope : [limit] }, q, pages=(n_clicks or 0) + 1)
 
 @app.callback(
     Output('map-search-term-hidden', 'value'),
@@ -274,8 +295,15 @@ def map_search(word_query, maptype, mapscope):
         word_query=json.loads(word_query)
         word = word_query['word']
         compare_word = word_query['compare']
-        plotdata, layout = build_map(word, compare_word, maptype, mapscope)
-        fig = dict( data=plotdata, layout=layout )
+        try:
+            plotdata, layout = within_deadline(build_map, word, compare_word, maptype, mapscope)
+        except Exception:
+            # Too slow or failed: show the last known map. A slow fetch carries
+            # on in the background and refreshes the cache.
+            logging.warning("Map for %r not ready in time, using cached data", word_query, exc_info=True)
+            plotdata, layout = build_map(word, compare_word, maptype, mapscope, stale=True)
+            layout['title'] += ' (stale)'
+        fig = figures.compact(dict( data=plotdata, layout=layout ))
     except:
         logging.exception(json.dumps(dict(page='map', word_query=word_query,
                                           maptype=maptype, mapscope=mapscope)))
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+'''
+Vectorized facet × year matrices.
+
+Bookworm returns long results with one row per (facet value, year). These
+helpers pivot them once into a dense NumPy array, with missing years as zero,
+so transforms like log scaling and smoothing run on whole arrays at once.
+'''
+import numpy as np
+import metrics
+
+def pivot(df, row, col='date_year', value='WordsPerMillion', min_col=None, max_col=None):
+    '''
+    Pivot a long frame into (row_labels, columns, values). Rows are the sorted
+    unique values of `row`. Columns run over every integer from min_col to
+    max_col, which default to the range in the data and are widened to cover
+    it. Missing cells are zero.
+    '''
+    labels, row_idx = np.unique(df[row].values, return_inverse=True)
+    col_values = df[col].values.astype(int)
+    if len(col_values):
+        lo, hi = col_values.min(), col_values.max()
+        min_col = lo if min_col is None else min(min_col, lo)
+        max_col = hi if max_col is None else max(max_col, hi)
+    elif min_col is None or max_col is None:
+        return labels, np.arange(0), np.zeros((0, 0))
+    columns = np.arange(min_col, max_col + 1)
+    values = np.zeros((len(labels), len(columns)))
+    values[row_idx, col_values - min_col] = df[value].values
+    return labels, columns, values
+
+def smooth_rows(values, window):
+    '''
+    Trailing moving average of each row, like
+    Series.rolling(window, min_periods=1).mean(), computed from cumulative
+    sums so the cost doesn't depend on the window. Rows never mix.
+    '''
+    if window is None or window <= 1 or values.shape[1] == 0:
+        return values
+    csum = np.cumsum(values, axis=1)
+    sums = csum.copy()
+    sums[:, window:] = csum[:, window:] - csum[:, :-window]
+    counts = np.minimum(np.arange(1, values.shape[1] + 1), window)
+    return sums / counts
+
+class Matrix(object):
+    '''
+    A prepared matrix with row labels and integer columns. select() slices
+    out a block without copying any more than the block itself.
+    '''
+
+    def __init__(self, labels, columns, values):
+        self.labels = labels
+        self.columns = columns
+        self.values = values
+        self._index = {label: i for i, label in enumerate(labels)}
+
+    @classmethod
+    @metrics.timed('transform')
+    def from_frame(cls, df, row, col='date_year', value='WordsPerMillion',
+                   min_col=None, max_col=None, log=False, smoothing=None):
+        ''' Pivot, log scale (log1p) and smooth long results in one go. '''
+        labels, columns, values = pivot(df, row, col, value, min_col, max_col)
+        if log:
+            values = np.log1p(values)
+        if smoothing:
+            values = smooth_rows(values, smoothing)
+        return cls(labels, columns, values)
+
+    def __contains__(self, label):
+        return label in self._index
+
+    def row(self, label):
+        ''' The values for one row label. '''
+        return self.values[self._index[label]]
+
+    @metrics.timed('transform')
+    def select(self, rows=None, min_col=None, max_col=None):
+        '''
+        The block for some row labels (all if empty or None, unknown labels
+        are ignored) and an inclusive column range. Rows keep matrix order.
+        '''
+        values = self.values
+        labels = self.labels
+        if rows:
+            idx = sorted(self._index[r] for r in set(rows) if r in self._index)
+            values = values[idx]
+            labels = labels[idx]
+        lo = 0 if min_col is None else int(np.searchsorted(self.columns, min_col, 'left'))
+        hi = len(self.columns) if max_col is None else int(np.searchsorted(self.columns, max_col, 'right'))
+        return Matrix(labels, self.columns[lo:hi], values[:, lo:hi])
+
+    @metrics.timed('transform')
+    def bin_columns(self, width):
+        '''
+        Average the columns into bins `width` wide, aligned on multiples of
+        the width (1900-1909, 1910-1919, ...). Bins at either end may be
+        partial. Columns of the result are the bins' aligned starts, so
+        the first may lie before the first column (1895 for 1897-1899 in
+        5-year bins).
+        '''
+        if width <= 1 or len(self.columns) == 0:
+            return self
+        bins = (self.columns // width) * width
+        starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+        counts = np.diff(np.r_[starts, len(self.columns)])
+        values = np.add.reduceat(self.values, starts, axis=1) / counts
+        return Matrix(self.labels, bins[starts], values)
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+'''
+In-process counters and latency histograms, and per-request phase timing.
+
+Code on the hot path marks its phases (remote query, frame conversion,
+transform, figure build) with `phase()` or `timed()`. While a request is
+being traced (see instrument.py), the time spent in each phase, excluding
+nested phases, is added up for that request.
+'''
+import time
+import cProfile
+import threading
+import functools
+from contextlib import contextmanager
+
+# Upper bounds, in seconds, for latency histograms
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf'))
+# Upper bounds, in bytes, for size histograms
+size_buckets = (1e3, 1e4, 3e4, 1e5, 3e5, 1e6, 3e6, 1e7, float('inf'))
+
+class Histogram(object):
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.sum += value
+            self.count += 1
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+    def snapshot(self):
+        ''' Cumulative bucket counts, as Prometheus reports them. '''
+        with self._lock:
+            cumulative = []
+            total = 0
+            for bound, n in zip(self.buckets, self.counts):
+                total += n
+                cumulative.append((bound, total))
+            return {'buckets': cumulative, 'sum': self.sum, 'count': self.count}
+
+class Counter(object):
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+def _get(factory, name, labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _registry_lock:
+        if key not in _registry:
+            _registry[key] = factory()
+        return _registry[key]
+
+def histogram(name, buckets=default_buckets, **labels):
+    ''' The histogram for a metric name and set of labels, created on first use. '''
+    return _get(lambda: Histogram(buckets), name, labels)
+
+def counter(name, **labels):
+    ''' The counter for a metric name and set of labels, created on first use. '''
+    return _get(Counter, name, labels)
+
+def collect():
+    ''' All metrics, as a list of (name, labels, metric). '''
+    with _registry_lock:
+        items = list(_registry.items())
+    return [(name, dict(labels), metric) for (name, labels), metric in sorted(items, key=lambda i: i[0])]
+
+def render(extra=()):
+    '''
+    All metrics in the Prometheus text exposition format. `extra` is a list
+    of (name, labels, value) gauges to add, for values kept elsewhere.
+    '''
+    def fmt_labels(labels):
+        if not labels:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                 for k, v in sorted(labels.items()))
+
+    lines = []
+    typed = set()
+    for name, labels, metric in collect():
+        if isinstance(metric, Histogram):
+            if name not in typed:
+                lines.append('# TYPE %s histogram' % name)
+                typed.add(name)
+            snap = metric.snapshot()
+            for bound, count in snap['buckets']:
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                lines.append('%s_bucket%s %d' % (name, fmt_labels(dict(labels, le=le)), count))
+            lines.append('%s_sum%s %r' % (name, fmt_labels(labels), snap['sum']))
+            lines.append('%s_count%s %d' % (name, fmt_labels(labels), snap['count']))
+        else:
+            if name not in typed:
+                lines.append('# TYPE %s counter' % name)
+                typed.add(name)
+            lines.append('%s%s %d' % (name, fmt_labels(labels), metric.value))
+    for name, labels, value in extra:
+        if name not in typed:
+            lines.append('# TYPE %s gauge' % name)
+            typed.add(name)
+        lines.append('%s%s %r' % (name, fmt_labels(labels), float(value)))
+    return '\n'.join(lines) + '\n'
+
+class Trace(object):
+    ''' Time per phase for one request. '''
+
+    def __init__(self):
+        self.phases = {}
+        # The callback's own run time, excluding serialization
+        self.own = None
+        # A list while the request is profiled: the profiles of work bound
+        # to it on other threads, once that work is done
+        self.profiles = None
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def add_profile(self, profiler):
+        with self._lock:
+            self.profiles.append(profiler)
+
+    def bound_profiles(self):
+        with self._lock:
+            return list(self.profiles or [])
+
+_local = threading.local()
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+@contextmanager
+def tracing():
+    ''' Trace phases on this thread until the block ends. Yields the Trace. '''
+    previous, previous_stack = current_trace(), getattr(_local, 'stack', None)
+    trace = _local.trace = Trace()
+    _local.stack = []
+    try:
+        yield trace
+    finally:
+        _local.trace, _local.stack = previous, previous_stack
+
+@contextmanager
+def phase(name):
+    '''
+    Time a phase of the current request. Time spent in phases nested inside
+    this one is counted for them, not for this one.
+    '''
+    trace = current_trace()
+    if trace is None:
+        yield
+        return
+    stack = _local.stack
+    frame = [0.0]  # time taken by nested phases
+    stack.append(frame)
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        stack.pop()
+        if stack:
+            stack[-1][0] += elapsed
+        trace.add(name, elapsed - frame[0])
+
+def timed(name):
+    ''' Decorator: time every call of a function as a phase. '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def bind(func):
+    '''
+    Wrap func so that, when run on another thread, its phases count towards
+    the request that is current here, and if the request is profiled, so is
+    func.
+    '''
+    trace = current_trace()
+    if trace is None:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        previous, previous_stack = current_trace(), getattr(_local, 'stack', None)
+        _local.trace, _local.stack = trace, []
+        try:
+            if trace.profiles is None:
+                return func(*args, **kwargs)
+            # A profiler only sees the thread it runs on
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(func, *args, **kwargs)
+            finally:
+                trace.add_profile(profiler)
+        finally:
+            _local.trace, _local.stack = previous, previous_stack
+    return wrapper
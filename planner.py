@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+'''
+Answer Bookworm queries from the responses to broader ones.
+
+Queries are first put in a canonical form: search words are stripped,
+de-duplicated and sorted, and case-folded when the collation is case
+insensitive, and lists of limit values are sorted. Two queries that only
+differ in those ways get the same answer.
+
+A query is contained in another when they differ only in
+  - the limits on fields they are both grouped by, where the narrower
+    query's values are a subset (for lists) or sub-range (for $lt/$gt
+    style limits) of the broader one's,
+  - their counttypes, where the narrower query asks for a subset.
+Because each cell of a grouped response is counted independently, the
+narrower answer is the broader response with the other cells and
+counttypes dropped.
+
+Limits on ranks (`field__id`) must match exactly: a response doesn't say
+which rank a value has.
+
+A query is never answered from its own earlier response. Repeats are the
+result cache's business, and the planner would only hide newer data from
+them.
+
+    BW_PLANNER_MAX_CELLS  response cells kept in memory (default: 250000)
+    BW_PLANNER_TTL        seconds a response is used for (default: one hour)
+'''
+import os
+import json
+import time
+import threading
+import collections
+
+_ops = {'$lt': lambda x, v: x < v, '$lte': lambda x, v: x <= v,
+        '$gt': lambda x, v: x > v, '$gte': lambda x, v: x >= v}
+
+def _case_insensitive(query):
+    return query.get('words_collation', '').lower() == 'case_insensitive'
+
+def canonical(query):
+    ''' A copy of a query in canonical form. '''
+    query = json.loads(json.dumps(query))
+    limits = query.get('search_limits', {})
+    if isinstance(limits, dict):
+        for key, value in list(limits.items()):
+            if key == 'word':
+                words = value if isinstance(value, list) else [value]
+                words = [w.strip() for w in words if w.strip()]
+                if _case_insensitive(query):
+                    words = [w.casefold() for w in words]
+                limits[key] = sorted(set(words))
+            elif isinstance(value, list):
+                limits[key] = sorted(set(value), key=lambda v: (str(type(v)), v))
+    return query
+
+def canonical_key(query):
+    ''' A string equal for queries that get the same answer. '''
+    return json.dumps(canonical(query), sort_keys=True)
+
+def _fields(query):
+    return [group.lstrip('*') for group in query.get('groups', [])]
+
+def _narrowable(query):
+    # Grouped fields whose limits only decide which cells are returned.
+    # Words are matched by collation, so their limits must always be equal.
+    return set(_fields(query)) - {'word'}
+
+def _shape(query):
+    # Everything a containing query must have in common with this one
+    shape = dict(query)
+    limits = shape.get('search_limits', {})
+    if isinstance(limits, dict):
+        grouped = _narrowable(query)
+        shape['search_limits'] = {k: v for k, v in limits.items() if k not in grouped}
+    shape.pop('counttype', None)
+    return json.dumps(shape, sort_keys=True)
+
+def _range(limit):
+    # (lo, lo inclusive, hi, hi inclusive) for a dict of $lt/$gt style limits
+    lo, lo_inc, hi, hi_inc = float('-inf'), True, float('inf'), True
+    for op, value in limit.items():
+        value = float(value)
+        if op in ('$gt', '$gte') and (value > lo or (value == lo and op == '$gt')):
+            lo, lo_inc = value, op == '$gte'
+        elif op in ('$lt', '$lte') and (value < hi or (value == hi and op == '$lt')):
+            hi, hi_inc = value, op == '$lte'
+    return lo, lo_inc, hi, hi_inc
+
+def _narrower(narrow, broad):
+    ''' Whether every value the `narrow` limit allows is allowed by `broad`. '''
+    if broad is None:
+        return True
+    if narrow is None:
+        return False
+    if isinstance(broad, dict):
+        if not set(broad) <= set(_ops):
+            return False
+        if isinstance(narrow, dict):
+            if not set(narrow) <= set(_ops):
+                return False
+            n_lo, n_lo_inc, n_hi, n_hi_inc = _range(narrow)
+            b_lo, b_lo_inc, b_hi, b_hi_inc = _range(broad)
+            return ((n_lo > b_lo or (n_lo == b_lo and (b_lo_inc or not n_lo_inc))) and
+                    (n_hi < b_hi or (n_hi == b_hi and (b_hi_inc or not n_hi_inc))))
+        values = narrow if isinstance(narrow, list) else [narrow]
+        return all(_allows(broad, v) for v in values)
+    if isinstance(narrow, dict):
+        return False
+    narrow = narrow if isinstance(narrow, list) else [narrow]
+    broad = broad if isinstance(broad, list) else [broad]
+    return set(str(v) for v in narrow) <= set(str(v) for v in broad)
+
+def _allows(limit, value):
+    ''' Whether a response key passes a limit. '''
+    if limit is None:
+        return True
+    if isinstance(limit, dict):
+        try:
+            x = float(value)
+        except (TypeError, ValueError):
+            return False
+        return all(_ops[op](x, float(v)) for op, v in limit.items())
+    limit = limit if isinstance(limit, list) else [limit]
+    return str(value) in set(str(v) for v in limit)
+
+def contains(broad, narrow):
+    ''' Whether the canonical query `narrow` can be answered from `broad`'s response. '''
+    if broad.get('method', 'return_json') != 'return_json' or _shape(broad) != _shape(narrow):
+        return False
+    if not set(narrow.get('counttype', [])) <= set(broad.get('counttype', [])):
+        return False
+    b_limits, n_limits = broad.get('search_limits', {}), narrow.get('search_limits', {})
+    if not (isinstance(b_limits, dict) and isinstance(n_limits, dict)):
+        return b_limits == n_limits
+    return all(_narrower(n_limits.get(f), b_limits.get(f)) for f in _narrowable(narrow))
+
+def narrow_response(response, broad, narrow):
+    ''' The answer to `narrow`, cut out of the response to `broad`, which contains it. '''
+    fields = _fields(narrow)
+    narrowable = _narrowable(narrow)
+    limits = narrow.get('search_limits', {})
+    limits = {f: v for f, v in limits.items() if f in narrowable} if isinstance(limits, dict) else {}
+    counttypes = broad.get('counttype', [])
+    picks = [counttypes.index(c) for c in narrow.get('counttype', [])]
+
+    def walk(node, depth):
+        if depth == len(fields):
+            return [node[i] for i in picks]
+        limit = limits.get(fields[depth])
+        children = ((key, walk(child, depth + 1)) for key, child in node.items()
+                    if _allows(limit, key))
+        # The endpoint leaves out a branch with no cells, so do the same
+        return {key: child for key, child in children if child != {}}
+    return walk(response, 0)
+
+def _cells(response):
+    if isinstance(response, dict):
+        return sum(_cells(child) for child in response.values())
+    return 1
+
+class Planner(object):
+    ''' Recent responses, indexed so that contained queries can find them. '''
+
+    def __init__(self, max_cells=250000, ttl=3600):
+        self.max_cells = max_cells
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # canonical key -> (canonical query, response, cells, expires), least recent first
+        self._entries = collections.OrderedDict()
+        self._shapes = collections.defaultdict(set)
+        self._cells = 0
+
+    def remember(self, query, response):
+        ''' Keep the response to a return_json query. '''
+        query = canonical(query)
+        if query.get('method', 'return_json') != 'return_json' or not isinstance(response, dict):
+            return
+        key, shape, cells = json.dumps(query, sort_keys=True), _shape(query), _cells(response)
+        if cells > self.max_cells:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._cells -= self._entries.pop(key)[2]
+            self._entries[key] = (query, response, cells, time.time() + self.ttl)
+            self._shapes[shape].add(key)
+            self._cells += cells
+            while self._cells > self.max_cells:
+                old_key, (old_query, _, old_cells, _) = self._entries.popitem(last=False)
+                self._shapes[_shape(old_query)].discard(old_key)
+                self._cells -= old_cells
+
+    def answer(self, query):
+        '''
+        The response to a query from a remembered broader one that contains
+        it, or None.
+        '''
+        query = canonical(query)
+        key = json.dumps(query, sort_keys=True)
+        with self._lock:
+            candidates = [self._entries[k] for k in self._shapes.get(_shape(query), ()) if k != key]
+        now = time.time()
+        # The smallest containing response is the cheapest to cut down
+        for broad, response, _, expires in sorted(candidates, key=lambda entry: entry[2]):
+            if expires >= now and contains(broad, query):
+                return narrow_response(response, broad, query)
+        return None
+
+planner = Planner(int(os.environ.get('BW_PLANNER_MAX_CELLS', 250000)),
+                  ttl=float(os.environ.get('BW_PLANNER_TTL', 3600)))
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+'''
+Preload-and-fork mode for gunicorn.
+
+Run with the settings in gunicorn.conf.py:
+
+    gunicorn -c gunicorn.conf.py app:server
+
+The master process then builds everything that doesn't change while the
+app runs: the facet metadata, the place code tables, the pages (their
+layouts and callbacks) and the mapped aggregate store. Workers are forked
+from it and share those pages of memory copy-on-write instead of each
+building their own, so a new worker is ready at once.
+
+Everything the master built is moved out of the garbage collector's reach
+with gc.freeze() (Python 3.7+), so that collections in a worker don't
+write to, and so copy, the shared pages. The aggregate counts are mapped
+files, which are shared whatever happens to them. The master starts no
+threads; the cache warmer is started in each worker after the fork.
+'''
+import gc
+import random
+import logging
+import facets
+import geocodes
+import aggregates
+import warmer
+
+# Whether the app is being preloaded in a gunicorn master
+active = False
+
+def enable():
+    ''' Called from the gunicorn settings, before the app is imported. '''
+    global active
+    active = True
+
+def prepare(load):
+    '''
+    Build the immutable state in this (master) process. `load` loads the
+    pages.
+    '''
+    # A stale snapshot is refreshed by the workers, not here, and a missing
+    # one is fetched without the thread pool
+    facets.store.background_refresh = False
+    facets.store.snapshot()
+    for field in geocodes.tables:
+        geocodes.index(field)
+    aggregates.store.open_all()
+    load()
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    logging.info("Preloaded app state for workers")
+
+def after_fork():
+    ''' Per-worker setup, called in each worker right after it is forked. '''
+    # Otherwise every worker would draw the same retry jitter
+    random.seed()
+    facets.store.background_refresh = True
+    warmer.start()
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+'''
+An offline stand-in for the Bookworm API endpoint (dbbindings.py).
+
+It speaks the same JSON protocol (GET or POST with `queryTerms`) for the
+query shapes this app sends: returnPossibleFields, return_json queries with
+groups/search_limits/counttype, and search_results. It runs in one of three
+modes:
+
+    synthetic  Answer from a generated corpus. --facets sets how many values
+               each character field has, so pages can be exercised at scale.
+    record     Forward to the real endpoint and save every response as a
+               fixture.
+    replay     Answer from saved fixtures, optionally falling back to the
+               synthetic corpus for queries that were never recorded.
+
+Synthetic latency can be added to any mode with --latency and --jitter.
+
+    python standin.py synthetic --port 8081 --facets 500 --latency 0.2
+    BOOKWORM_ENDPOINT=http://localhost:8081/cgi-bin/dbbindings.py gunicorn app:server
+'''
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import hashlib
+import argparse
+import tempfile
+import threading
+import itertools
+import logging
+import flask
+import numpy as np
+import pandas as pd
+import requests
+
+default_upstream = 'https://bookworm.htrc.illinois.edu/cgi-bin/dbbindings.py'
+
+def query_key(query):
+    ''' Fixture name for a query: a hash of its canonical JSON. '''
+    return hashlib.sha1(json.dumps(query, sort_keys=True).encode('utf-8')).hexdigest()
+
+def _weight(value):
+    # A stable pseudo-random weight in [0.5, 1.5) for any value
+    return 0.5 + (zlib.crc32(str(value).encode('utf-8')) % 1000) / 1000.
+
+class SyntheticCorpus(object):
+    '''
+    A generated Bookworm. Every count is a deterministic function of the cell
+    it describes, so overlapping queries agree with each other.
+    '''
+    character_fields = ['publication_country', 'publication_state', 'language', 'class',
+                        'subclass', 'format', 'literary_form', 'resource_type']
+
+    def __init__(self, facets=50, min_year=1650, max_year=2015):
+        self.min_year = min_year
+        self.max_year = max_year
+        self.facets = facets
+        here = os.path.dirname(os.path.abspath(__file__))
+        self._values = {
+            'publication_country': pd.read_csv(os.path.join(here, 'data', 'country_codes.csv'))
+                                     .publication_country.tolist(),
+            'publication_state': pd.read_csv(os.path.join(here, 'data', 'state_codes_us.csv'))
+                                   .publication_state.tolist()
+        }
+
+    def fields(self):
+        fields = [{'name': name, 'type': 'character', 'dbname': name} for name in self.character_fields]
+        fields.append({'name': 'date_year', 'type': 'integer', 'dbname': 'date_year'})
+        return fields
+
+    def values(self, field):
+        ''' All values of a field, most common (lowest __id) first. '''
+        if field == 'date_year':
+            return list(range(self.min_year, self.max_year + 1))
+        if field not in self._values:
+            self._values[field] = ["%s %04d" % (field.replace('_', ' ').title(), i)
+                                   for i in range(1, self.facets + 1)]
+        return self._values[field]
+
+    def _limited_values(self, field, limits):
+        values = self.values(field)
+        if field == 'date_year':
+            limit = limits.get('date_year')
+            if isinstance(limit, dict):
+                ops = {'$lt': lambda v, x: v < x, '$lte': lambda v, x: v <= x,
+                       '$gt': lambda v, x: v > x, '$gte': lambda v, x: v >= x}
+                for op, x in limit.items():
+                    values = [v for v in values if ops[op](v, int(x))]
+            elif limit is not None:
+                allowed = set(int(x) for x in (limit if isinstance(limit, list) else [limit]))
+                values = [v for v in values if v in allowed]
+            return values
+        id_limit = limits.get(field + '__id')
+        if isinstance(id_limit, dict):
+            if '$lt' in id_limit:
+                values = values[:max(int(id_limit['$lt']) - 1, 0)]
+            elif '$lte' in id_limit:
+                values = values[:int(id_limit['$lte'])]
+        limit = limits.get(field)
+        if limit is not None:
+            allowed = set(limit if isinstance(limit, list) else [limit])
+            values = [v for v in values if v in allowed]
+        return values
+
+    def _counts(self, groups, limits, counttypes):
+        words = limits.get('word', [])
+        word_weight = np.prod([_weight(w.lower()) for w in words]) if words else 1.0
+        axes = []
+        weights = []
+        for group in groups:
+            field = group.lstrip('*')
+            values = self._limited_values(field, limits)
+            axes.append(values)
+            if field == 'date_year':
+                years = np.array(values, dtype=float)
+                w = np.exp((years - self.min_year) / 120.) * np.array([_weight(y) for y in values])
+            else:
+                # Rank in the whole field, so that limits don't change a value's weight
+                position = {v: i for i, v in enumerate(self.values(field))}
+                ranks = np.array([position[v] + 1 for v in values], dtype=float)
+                w = np.array([_weight(v) for v in values]) / np.sqrt(ranks)
+            weights.append(w)
+        # Multiply the per-axis weights into a grid with one cell per group combination
+        grid = np.array(word_weight)
+        for w in weights:
+            grid = np.multiply.outer(grid, w)
+        columns = {
+            'WordsPerMillion': grid * 25,
+            'TextCount': np.floor(grid * 2000),
+            'WordCount': np.floor(grid * 2000 * 60000),
+            'TextPercent': grid,
+            'WordsRatio': grid / 100
+        }
+        return axes, [columns.get(c, grid) for c in counttypes]
+
+    def query(self, query):
+        method = query.get('method', 'return_json')
+        limits = query.get('search_limits', {})
+        if isinstance(limits, list):
+            limits = limits[0] if limits else {}
+        if method == 'returnPossibleFields':
+            return self.fields()
+        if method == 'search_results':
+            return self.search_results(limits)
+
+        groups = query.get('groups', [])
+        groups = groups if isinstance(groups, list) else [groups]
+        counttypes = query.get('counttype', ['TextCount', 'WordCount'])
+        counttypes = counttypes if isinstance(counttypes, list) else [counttypes]
+        axes, grids = self._counts(groups, limits, counttypes)
+
+        response = {} if axes else [float(g) for g in grids]
+        for idx in itertools.product(*[range(len(a)) for a in axes]):
+            node = response
+            for depth, i in enumerate(idx):
+                key = str(axes[depth][i])
+                if depth == len(idx) - 1:
+                    node[key] = [float(g[idx]) for g in grids]
+                else:
+                    node = node.setdefault(key, {})
+        return response
+
+    def search_results(self, limits, n=20):
+        rng = random.Random(json.dumps(limits, sort_keys=True))
+        results = []
+        for i in range(n):
+            ident = rng.randint(0, 10**6)
+            year = rng.randint(self.min_year, self.max_year)
+            results.append("<a href=https://hdl.handle.net/2027/syn.%06d><em>Synthetic Volume %d</em> (%d)</a>"
+                           % (ident, ident, year))
+        return results
+
+class StandIn(object):
+
+    def __init__(self, mode='synthetic', fixtures='fixtures', upstream=default_upstream,
+                 corpus=None, latency=0, jitter=0, fallback=False):
+        self.mode = mode
+        self.fixtures = fixtures
+        self.upstream = upstream
+        self.corpus = corpus or SyntheticCorpus()
+        self.latency = latency
+        self.jitter = jitter
+        self.fallback = fallback
+        self._session = requests.Session()
+        if mode in ('record', 'replay'):
+            os.makedirs(fixtures, exist_ok=True)
+
+    def _fixture_path(self, query):
+        return os.path.join(self.fixtures, query_key(query) + '.json')
+
+    def record(self, query):
+        r = self._session.get(self.upstream, params={'queryTerms': json.dumps(query)}, timeout=120)
+        r.raise_for_status()
+        response = r.json()
+        with open(self._fixture_path(query), 'w') as f:
+            json.dump({'query': query, 'response': response}, f)
+        return response
+
+    def replay(self, query):
+        try:
+            with open(self._fixture_path(query), 'r') as f:
+                return json.load(f)['response']
+        except (IOError, OSError):
+            if self.fallback:
+                return self.corpus.query(query)
+            raise KeyError("No fixture for query %s" % json.dumps(query, sort_keys=True))
+
+    def answer(self, query):
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if self.mode == 'record':
+            return self.record(query)
+        elif self.mode == 'replay':
+            return self.replay(query)
+        return self.corpus.query(query)
+
+    def make_app(self):
+        app = flask.Flask('standin')
+
+        def dbbindings():
+            raw = flask.request.values.get('queryTerms')
+            if raw is None:
+                return flask.Response(json.dumps({'error': 'No queryTerms'}), status=400,
+                                      mimetype='application/json')
+            try:
+                response = self.answer(json.loads(raw))
+            except KeyError as e:
+                return flask.Response(json.dumps({'error': str(e)}), status=404,
+                                      mimetype='application/json')
+            return flask.Response(json.dumps(response), mimetype='application/json')
+
+        app.add_url_rule('/', 'root', dbbindings, methods=['GET', 'POST'])
+        app.add_url_rule('/cgi-bin/dbbindings.py', 'dbbindings', dbbindings, methods=['GET', 'POST'])
+        return app
+
+    def serve_in_thread(self, host='127.0.0.1', port=0):
+        '''
+        Serve from a background thread, for benchmarks and load tests.
+        Returns the endpoint URL and the server (call shutdown() to stop it).
+        '''
+        from werkzeug.serving import make_server, WSGIRequestHandler
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+        server = make_server(host, port, self.make_app(), threaded=True,
+                             request_handler=QuietHandler)
+        threading.Thread(target=server.serve_forever, name='standin', daemon=True).start()
+        return 'http://%s:%d/cgi-bin/dbbindings.py' % (host, server.port), server
+
+def use_locally(facets=50, latency=0, jitter=0):
+    '''
+    Serve a synthetic stand-in from a background thread and point this
+    process's app at it, with its result cache, facet snapshot, aggregate
+    store and popularity database in a scratch directory (unless they are
+    set in the environment), and the cache warmer off. The facet snapshot
+    is fetched from the stand-in if it is missing, as a deploy would. Call
+    it before bookworm is imported. Returns the endpoint URL.
+    '''
+    endpoint, _ = StandIn(corpus=SyntheticCorpus(facets=facets),
+                          latency=latency, jitter=jitter).serve_in_thread()
+    scratch = tempfile.mkdtemp(prefix='bw-standin-')
+    os.environ['BOOKWORM_ENDPOINT'] = endpoint
+    os.environ.setdefault('BW_CACHE_PATH', os.path.join(scratch, 'results.db'))
+    os.environ.setdefault('BW_FACET_SNAPSHOT', os.path.join(scratch, 'facets.json'))
+    os.environ.setdefault('BW_AGGREGATES', os.path.join(scratch, 'aggregates'))
+    os.environ.setdefault('BW_WARMER_DB', os.path.join(scratch, 'popularity.db'))
+    os.environ.setdefault('BW_WARMER', '0')
+    import facets
+    if facets.store.stale():
+        facets.store.refresh()
+    return endpoint
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline stand-in for the Bookworm API.")
+    parser.add_argument('mode', choices=['synthetic', 'record', 'replay'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--fixtures', default='fixtures', help="Fixture directory")
+    parser.add_argument('--upstream', default=default_upstream, help="Endpoint to record from")
+    parser.add_argument('--fallback', action='store_true',
+                        help="In replay mode, answer unrecorded queries synthetically")
+    parser.add_argument('--facets', type=int, default=50,
+                        help="Values per synthetic character field")
+    parser.add_argument('--latency', type=float, default=0, help="Seconds added to each response")
+    parser.add_argument('--jitter', type=float, default=0, help="Random +/- seconds on the latency")
+    args = parser.parse_args(argv)
+
+    standin = StandIn(args.mode, fixtures=args.fixtures, upstream=args.upstream,
+                      corpus=SyntheticCorpus(facets=args.facets), latency=args.latency,
+                      jitter=args.jitter, fallback=args.fallback)
+    logging.basicConfig(level=logging.INFO)
+    standin.make_app().run(host=args.host, port=args.port, threaded=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
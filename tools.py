@@ -1,7 +1,7 @@
 from common import app
-import dash_html_components as html
-import dash_core_components as dcc
 import plotly.graph_objs as go
+import facets
+import threading
 import logging
 
 logging_config = dict(
@@ -54,12 +54,37 @@ def load_page(path):
 
     return scope['layout']
 
+class LazyPage(object):
+    '''
+    A page that is only loaded (executed, registering its callbacks, and
+    its layout built) the first time it is needed.
+    '''
+    _lock = threading.RLock()
+
+    def __init__(self, path):
+        self.path = path
+        self._layout = None
+
+    @property
+    def loaded(self):
+        return self._layout is not None
+
+    def load(self):
+        with self._lock:
+            if self._layout is None:
+                self._layout = load_page(self.path)
+        return self._layout
+
+    @property
+    def layout(self):
+        return self.load()
+
 def pretty_facet(name):
     return name.replace('_', ' ').title()
 
-def get_facet_group_options(bw):
+def get_facet_group_options():
     options = [{'label': pretty_facet(name), 'value': name} for name in 
-                  bw.fields().query("type == 'character'").name]
+                  facets.store.fields('character')]
     return options
 
 def errorfig(txt='There was an error! We\'ve logged it and will try to fix it. Try something else!'): 
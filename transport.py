@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+'''
+HTTP transport to the Bookworm API endpoint, shared by all pages.
+
+Requests go through one requests.Session per process, which keeps a bounded
+pool of keep-alive connections. Every request has connect and read timeouts,
+and connection errors, timeouts and 5xx responses are retried with jittered
+exponential backoff until a per-query deadline. Latency is recorded per query
+kind (map, heatmap, bar, search_results, ...) in metrics.
+
+Configured through the environment:
+
+    BOOKWORM_POOL_SIZE        connections kept open per process (default: 10)
+    BOOKWORM_CONNECT_TIMEOUT  seconds (default: 3.05)
+    BOOKWORM_READ_TIMEOUT     seconds (default: 30)
+    BOOKWORM_RETRIES          retries after the first attempt (default: 2)
+'''
+import os
+import json
+import time
+import random
+import threading
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
+
+class TransportError(Exception):
+    ''' The endpoint couldn't give a usable response before the deadline. '''
+    pass
+
+class Transport(object):
+
+    def __init__(self, endpoint, pool_size=10, connect_timeout=3.05, read_timeout=30,
+                 retries=2, backoff=0.25):
+        self.endpoint = endpoint
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+
+    @classmethod
+    def from_env(cls, endpoint):
+        return cls(endpoint,
+                   pool_size=int(os.environ.get('BOOKWORM_POOL_SIZE', 10)),
+                   connect_timeout=float(os.environ.get('BOOKWORM_CONNECT_TIMEOUT', 3.05)),
+                   read_timeout=float(os.environ.get('BOOKWORM_READ_TIMEOUT', 30)),
+                   retries=int(os.environ.get('BOOKWORM_RETRIES', 2)))
+
+    @property
+    def session(self):
+        # Sockets must not be shared with a forked child, so a new process
+        # gets a new session.
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size,
+                                      pool_block=True, max_retries=0)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+                self._pid = os.getpid()
+            return self._session
+
+    def _sleep_before_retry(self, attempt, deadline):
+        delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+        if time.time() + delay >= deadline:
+            return False
+        time.sleep(delay)
+        return True
+
+    def fetch(self, query, kind='query', connect_timeout=None, read_timeout=None, deadline=None):
+        '''
+        Send a query and return the decoded JSON response.
+
+        connect_timeout and read_timeout override the defaults for this
+        query. deadline is the total time, in seconds, allowed across all
+        attempts (default: one full attempt per retry).
+        '''
+        connect_timeout = connect_timeout or self.connect_timeout
+        read_timeout = read_timeout or self.read_timeout
+        if deadline is None:
+            deadline = (connect_timeout + read_timeout) * (self.retries + 1)
+        give_up_at = time.time() + deadline
+        params = {'queryTerms': json.dumps(query)}
+
+        attempt = 0
+        while True:
+            start = time.time()
+            remaining = max(give_up_at - start, 0.001)
+            timeout = (min(connect_timeout, remaining), min(read_timeout, remaining))
+            try:
+                r = self.session.get(self.endpoint, params=params, timeout=timeout)
+                if r.status_code >= 500:
+                    raise TransportError("Server error %d" % r.status_code)
+                r.raise_for_status()
+                response = r.json()
+                metrics.histogram('bookworm_query_seconds', kind=kind).observe(time.time() - start)
+                return response
+            except (requests.ConnectionError, requests.Timeout, TransportError) as e:
+                metrics.histogram('bookworm_query_seconds', kind=kind).observe(time.time() - start)
+                metrics.counter('bookworm_query_errors_total', kind=kind).inc()
+                if attempt >= self.retries or not self._sleep_before_retry(attempt, give_up_at):
+                    raise TransportError("%s query failed after %d attempt(s): %s" % (kind, attempt + 1, e))
+                logging.warning("Retrying %s query after error: %s", kind, e)
+                metrics.counter('bookworm_query_retries_total', kind=kind).inc()
+                attempt += 1
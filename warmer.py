@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+'''
+Keep the result cache warm for page defaults and popular queries.
+
+Every call of a cached data function (see cache.cached) is counted in a
+small SQLite table, by cache key, with the arguments needed to replay it.
+Pages name the calls their default view makes with keep_warm() when they
+are loaded. Once a page in this process has been loaded, a background
+thread warms the cache, and then again every BW_WARMER_INTERVAL seconds:
+first the defaults of the loaded pages, then the most popular recent calls
+to their cached functions. Only calls whose cached value isn't fresh are run, at most
+BW_WARMER_CONCURRENCY at a time, and only one process on a machine warms
+in each round.
+
+    BW_WARMER              set to 0 to turn warming off
+    BW_WARMER_DB           popularity database (default: cache/popularity.db)
+    BW_WARMER_TOP_K        popular calls warmed each round (default: 20)
+    BW_WARMER_WINDOW       how far back calls count, in seconds (default: 7 days)
+    BW_WARMER_INTERVAL     seconds between rounds (default: 30 minutes)
+    BW_WARMER_CONCURRENCY  calls warmed at once (default: 2)
+'''
+import os
+import time
+import pickle
+import sqlite3
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import cache
+
+class Popularity(object):
+    ''' Call counts, buffered in memory and written to SQLite in batches. '''
+
+    def __init__(self, path, flush_every=30):
+        self.path = path
+        self.flush_every = flush_every
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flushed = time.time()
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        conn = self._conn()
+        conn.execute('''CREATE TABLE IF NOT EXISTS calls (
+                            key TEXT PRIMARY KEY, namespace TEXT, call BLOB,
+                            count INTEGER, last REAL)''')
+        conn.execute('CREATE INDEX IF NOT EXISTS calls_last ON calls (last)')
+        conn.execute('''CREATE TABLE IF NOT EXISTS leases (
+                            name TEXT PRIMARY KEY, holder INTEGER, expires REAL)''')
+        conn.commit()
+
+    def _conn(self):
+        # One connection per thread, reopened after a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def record(self, namespace, key, args, kwargs):
+        now = time.time()
+        with self._lock:
+            if key in self._pending:
+                self._pending[key][2] += 1
+                self._pending[key][3] = now
+            else:
+                self._pending[key] = [namespace, pickle.dumps((args, kwargs)), 1, now]
+            due = now - self._flushed > self.flush_every
+        if due:
+            self.flush()
+
+    def flush(self):
+        ''' Write the buffered counts. '''
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushed = time.time()
+        if not pending:
+            return
+        conn = self._conn()
+        with conn:
+            for key, (namespace, call, count, last) in pending.items():
+                updated = conn.execute('UPDATE calls SET count = count + ?, last = ? WHERE key = ?',
+                                       (count, last, key)).rowcount
+                if not updated:
+                    conn.execute('INSERT INTO calls VALUES (?, ?, ?, ?, ?)',
+                                 (key, namespace, sqlite3.Binary(call), count, last))
+
+    def top(self, k, window):
+        ''' The k most called (namespace, args, kwargs) of the last `window` seconds. '''
+        rows = self._conn().execute('''SELECT namespace, call FROM calls WHERE last > ?
+                                       ORDER BY count DESC LIMIT ?''',
+                                    (time.time() - window, k)).fetchall()
+        calls = []
+        for namespace, call in rows:
+            try:
+                args, kwargs = pickle.loads(bytes(call))
+            except Exception:
+                continue
+            calls.append((namespace, args, kwargs))
+        return calls
+
+    def forget(self, window):
+        ''' Drop calls not made in the last `window` seconds. '''
+        conn = self._conn()
+        with conn:
+            conn.execute('DELETE FROM calls WHERE last < ?', (time.time() - window,))
+
+    def claim(self, name, seconds):
+        '''
+        Take a lease for `seconds`, unless another live process holds it.
+        Returns whether this process has it.
+        '''
+        now = time.time()
+        conn = self._conn()
+        # Each statement is atomic, so two processes can't both take a lease
+        # between reading and writing it
+        with conn:
+            taken = conn.execute('INSERT OR IGNORE INTO leases VALUES (?, ?, ?)',
+                                 (name, os.getpid(), now + seconds)).rowcount
+            if not taken:
+                taken = conn.execute('UPDATE leases SET holder = ?, expires = ? '
+                                     'WHERE name = ? AND (holder = ? OR expires <= ?)',
+                                     (os.getpid(), now + seconds, name, os.getpid(), now)).rowcount
+        return taken == 1
+
+    def release(self, name):
+        ''' Give up a lease held by this process. '''
+        conn = self._conn()
+        with conn:
+            conn.execute('DELETE FROM leases WHERE name = ? AND holder = ?', (name, os.getpid()))
+
+enabled = os.environ.get('BW_WARMER', '1') != '0'
+top_k = int(os.environ.get('BW_WARMER_TOP_K', 20))
+window = float(os.environ.get('BW_WARMER_WINDOW', 7*24*3600))
+interval = float(os.environ.get('BW_WARMER_INTERVAL', 30*60))
+concurrency = int(os.environ.get('BW_WARMER_CONCURRENCY', 2))
+
+popularity = Popularity(os.environ.get('BW_WARMER_DB', os.path.join('cache', 'popularity.db')))
+
+# (cached function, args, kwargs) for every page default
+defaults = []
+
+def keep_warm(func, *args, **kwargs):
+    ''' Keep a call of a cached function warm: it is the default view of a page. '''
+    defaults.append((func, args, kwargs))
+
+def _record(namespace, key, args, kwargs):
+    popularity.record(namespace, key, args, kwargs)
+
+def warm_once():
+    '''
+    Refresh every page default and popular call that isn't fresh. Returns
+    the number of calls run.
+    '''
+    popularity.flush()
+    calls = list(defaults)
+    seen = set((func.namespace, repr(args), repr(sorted(kwargs.items()))) for func, args, kwargs in calls)
+    for namespace, args, kwargs in popularity.top(top_k, window):
+        func = cache.registry.get(namespace)
+        marker = (namespace, repr(args), repr(sorted(kwargs.items())))
+        if func is not None and marker not in seen:
+            calls.append((func, args, kwargs))
+            seen.add(marker)
+
+    stale = [(func, args, kwargs) for func, args, kwargs in calls if not func.is_fresh(*args, **kwargs)]
+
+    def refresh(call):
+        func, args, kwargs = call
+        try:
+            func.refresh(*args, **kwargs)
+        except Exception:
+            logging.warning("Warming %s%r failed", func.namespace, args, exc_info=True)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(refresh, stale))
+    return len(stale)
+
+# Seconds between checks for a loaded page, before the first round
+wait_for_pages = 5
+
+def start():
+    '''
+    Start recording calls and warm the cache in a background thread. Pages
+    aren't loaded for it: it warms what the pages loaded so far registered.
+    '''
+    if _record not in cache.listeners:
+        cache.listeners.append(_record)
+    if not enabled:
+        return
+
+    def target():
+        # A round would claim the lease for nothing before any page is loaded
+        while not defaults:
+            time.sleep(wait_for_pages)
+        while True:
+            try:
+                if popularity.claim('warm', interval):
+                    started = time.time()
+                    n = warm_once()
+                    popularity.forget(window)
+                    logging.info("Warmed %d cached calls in %.1fs", n, time.time() - started)
+            except Exception:
+                logging.exception("Cache warming failed")
+            time.sleep(interval)
+    threading.Thread(target=target, name='cache-warmer', daemon=True).start()